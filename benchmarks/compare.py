@@ -0,0 +1,89 @@
+import argparse
+import json
+import sys
+
+from benchmarks.run import FORMAT_VERSION
+
+# environment entries that should match for timings to be comparable
+MACHINE_KEYS = ['platform', 'processor', 'cpus', 'python']
+
+
+def load_results(path):
+    with open(path) as f:
+        report = json.load(f)
+    if report.get('format') != FORMAT_VERSION:
+        raise ValueError('{} is not a benchmark result of format {}'.format(path, FORMAT_VERSION))
+    return report
+
+
+def compare(baseline, current, statistic='min', threshold=1.2, min_seconds=0.001):
+    # rows of (operation, elements, baseline s, current s, ratio, slower) for operations in both files;
+    # operations faster than 'min_seconds' in both are too noisy to count as a slowdown
+    before = {(r['operation'], r['elements']): r[statistic] for r in baseline['results']}
+    rows = []
+    for r in current['results']:
+        key = (r['operation'], r['elements'])
+        if key not in before:
+            continue
+        old, new = before[key], r[statistic]
+        ratio = new / old if old > 0 else float('inf')
+        slower = ratio > threshold and max(old, new) >= min_seconds
+        rows.append((key[0], key[1], old, new, ratio, slower))
+    return rows
+
+
+def unmatched(baseline, current):
+    # (only in the baseline, only in the current file) as 'operation@elements' strings
+    before = {(r['operation'], r['elements']) for r in baseline['results']}
+    after = {(r['operation'], r['elements']) for r in current['results']}
+
+    def label(keys):
+        return ['{}@{}'.format(*key) for key in sorted(keys, key=lambda key: (key[1], key[0]))]
+    return label(before - after), label(after - before)
+
+
+def print_report(rows, baseline, current, threshold):
+    for key in MACHINE_KEYS:
+        a, b = baseline['environment'].get(key), current['environment'].get(key)
+        if a != b:
+            print('warning: {} differs ({} vs {}), timings may not be comparable'.format(key, a, b))
+    print('baseline {} ({}), current {} ({})'.format(baseline['environment'].get('commit'), baseline['created'],
+                                                     current['environment'].get('commit'), current['created']))
+    print('{:<24}{:>9}{:>12}{:>12}{:>8}'.format('operation', 'elements', 'baseline', 'current', 'ratio'))
+    for operation, elements, old, new, ratio, slower in rows:
+        print('{:<24}{:>9}{:>11.4f}s{:>11.4f}s{:>8.2f}{}'.format(
+            operation, elements, old, new, ratio, '  SLOWER' if slower else ''))
+
+    only_before, only_after = unmatched(baseline, current)
+    if only_before:
+        print('only in the baseline: ' + ', '.join(only_before))
+    if only_after:
+        print('only in the current results: ' + ', '.join(only_after))
+    slowdowns = sum(row[5] for row in rows)
+    print('{} of {} operations slower than {:.2f}x the baseline'.format(slowdowns, len(rows), threshold))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.compare',
+                                     description='Compare two benchmark result files.')
+    parser.add_argument('baseline', help='JSON result file of the reference version')
+    parser.add_argument('current', help='JSON result file of the version under test')
+    parser.add_argument('-t', '--threshold', type=float, default=1.2,
+                        help='current/baseline time ratio above which an operation counts as slower')
+    parser.add_argument('--statistic', choices=['min', 'median'], default='min', help='sample statistic compared')
+    parser.add_argument('--min-seconds', type=float, default=0.001,
+                        help='operations faster than this in both files never count as slower')
+    args = parser.parse_args(argv)
+
+    try:
+        baseline, current = load_results(args.baseline), load_results(args.current)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 2
+    rows = compare(baseline, current, args.statistic, args.threshold, args.min_seconds)
+    print_report(rows, baseline, current, args.threshold)
+    return 1 if any(row[5] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
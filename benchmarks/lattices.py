@@ -0,0 +1,49 @@
+import os
+import re
+
+from classes.lattice import parse_lattice
+
+BASE_LATTICE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'PS_demo.lat')
+SIZES = [100, 1000, 10000, 100000]
+
+
+def read_base(path=BASE_LATTICE):
+    # (definitions, the beamline after the source as a 'cell' LINE, names of the cell's elements)
+    with open(path) as f:
+        text = f.read()
+    match = re.search(r'^PS\s*:\s*LINE\s*=\s*\(\s*S\s*,', text, re.MULTILINE)
+    if match is None:
+        raise ValueError(path + ' has no "PS: LINE = (S, ...)" beamline')
+    end = text.index(';', match.end())
+    cell = 'cell: LINE = (' + text[match.end():end].strip()[:-1] + ');\n'  # up to the closing parenthesis
+    names = [element['name'] for element in parse_lattice(path)['elements'][1:]]
+    return text[:match.start()], cell, names
+
+
+def write_lattice(size, path, base=BASE_LATTICE):
+    # 'size' elements including the source: the base beamline repeated, then as much of it as is left.
+    # The cell is repeated by the beamline rather than redefined, as the GLPS parser cannot hold
+    # tens of thousands of element definitions
+    definitions, cell, names = read_base(base)
+    copies, rest = divmod(size - 1, len(names))
+    line = ['S']
+    if copies:
+        line.append('{}*cell'.format(copies) if copies > 1 else 'cell')
+    text = definitions + cell
+    if rest:
+        text += 'tail: LINE = ({});\n'.format(', '.join(names[:rest]))
+        line.append('tail')
+    text += 'PS: LINE = ({});\nUSE: PS;\n'.format(', '.join(line))
+    with open(path, 'w') as f:
+        f.write(text)
+    return len(names)
+
+
+def make_names_unique(conf, cell_size):
+    # the copies of the cell get a suffix, so name lookups behave as in a lattice of distinct elements;
+    # the first copy keeps the base names
+    for i, element in enumerate(conf['elements'][1:]):
+        copy = i // cell_size
+        if copy:
+            element['name'] = '{}_{}'.format(element['name'], copy)
+    return conf
@@ -0,0 +1,194 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+from benchmarks.lattices import SIZES, make_names_unique, write_lattice
+
+FORMAT_VERSION = 1
+CANVAS_PARAMETERS = ['xrms', 'yrms', 'xtwiss_beta', 'ref_IonEk']  # three units, so up to three axes
+
+# the fixed optimization: two quadrupoles of the first cell matched to a beam size at the end of the lattice
+NELDER_MEAD_KNOBS = {'FS_F1S1:Q_D1013': 'B2', 'FS_F1S1:Q_D1024': 'B2'}
+NELDER_MEAD_TARGET = {'xrms': [1.0, 1.0], 'yrms': [1.0, 1.0]}
+NELDER_MEAD_ITERATIONS = 40
+
+
+def measure(func, setup=None, repeat=3, budget=10.0):
+    # run 'func' up to 'repeat' times, fewer once 'budget' seconds were spent; setup time is excluded
+    import globals as glb
+
+    samples = []
+    while len(samples) < repeat and sum(samples) < budget:
+        if setup is not None:
+            setup()
+        glb.app.processEvents()
+        t = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t)
+    glb.app.processEvents()
+    return samples
+
+
+def check_parameters(count):
+    # check the first 'count' canvas parameters in the parameter tree, without plotting them one by one
+    from PyQt5.QtCore import Qt
+    import globals as glb
+
+    param_select = glb.main_window.param_select
+    param_select.blockSignals(True)
+    for item in param_select.getLowLevelItems(param_select.invisibleRootItem()):
+        checked = param_select.convertItemIntoParam(item) in CANVAS_PARAMETERS[:count]
+        item.setCheckState(0, Qt.Checked if checked else Qt.Unchecked)
+    param_select.blockSignals(False)
+
+
+def optimization_problem(model):
+    from classes.model import serialize_model
+    import globals as glb
+
+    x0 = [model.get_element_by_name(name)['properties'][attr] for name, attr in NELDER_MEAD_KNOBS.items()]
+    return {'method': 'Nelder-Mead', 'x0': x0,
+            'conf': serialize_model(model), 'knobs': NELDER_MEAD_KNOBS,
+            'obj': {'location': len(model.machine) - 1, 'target': NELDER_MEAD_TARGET},
+            'workers': 1,
+            'maxiter': NELDER_MEAD_ITERATIONS,
+            'cache_size': glb.cost_cache_size,
+            'cache_tol': glb.cost_cache_tol}
+
+
+def run_optimization(problem):
+    from queue import SimpleQueue
+    from classes.optimization import optimize
+
+    queue = SimpleQueue()
+    optimize(problem, queue, None)
+    while not queue.empty():
+        msg = queue.get()
+    if msg[0] != 'done':
+        raise RuntimeError('optimization ended with {}: {}'.format(msg[0], msg[1]))
+
+
+def operations(path, model):
+    # (name, setup, timed function) of every benchmarked operation on a lattice of the given size
+    from classes.history import History
+    from classes.lattice import open_model
+    import globals as glb
+
+    window = glb.main_window
+    phase_window = window.menuBar().getWindow('phase_window')
+    select_window = window.menuBar().getWindow('opt_window').select_window
+    problem = optimization_problem(model)
+
+    def rerun():
+        model.bump_revision()
+        model.run(monitor='all')
+
+    def redraw():
+        window.canvas.refresh()
+        window.canvas.draw()
+
+    ops = [('open', None, lambda: open_model(path, use_cache=False)),
+           ('open_cached', None, lambda: open_model(path)),
+           ('model_run', None, rerun),
+           ('element_view_refresh', None, window.element_view.refresh)]
+    for count in range(1, len(CANVAS_PARAMETERS) + 1):
+        ops.append(('canvas_refresh_{}'.format(count), lambda count=count: check_parameters(count), redraw))
+    ops += [('phase_filter', None, phase_window.filterElementBox),
+            ('opt_select_refresh', select_window.clear, select_window.refresh),
+            ('undo_snapshot', None, lambda: History().begin(model)),
+            ('nelder_mead', None, lambda: run_optimization(problem))]
+    return ops
+
+
+def environment():
+    import flame
+    import matplotlib
+    import numpy as np
+    from PyQt5.QtCore import QT_VERSION_STR
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'flame': getattr(flame, '__version__', None),
+            'numpy': np.__version__,
+            'matplotlib': matplotlib.__version__,
+            'qt': QT_VERSION_STR}
+
+
+def run_benchmarks(sizes=SIZES, repeat=3, budget=10.0, skip=()):
+    from classes.lattice import load_conf, model_from_conf
+    import globals as glb
+
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    warnings.simplefilter('ignore', RuntimeWarning)  # the repeated cell diverges the beam of far copies
+    glb.app
+    from classes.windows import MainWindow
+    glb.main_window = MainWindow()
+    glb.main_window.resize(1280, 800)
+    glb.main_window.show()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            path = os.path.join(directory, 'synthetic_{}.lat'.format(size))
+            cell_size = write_lattice(size, path)
+            # the GUI operations use distinct element names, as a real lattice of this size would have
+            model = model_from_conf(make_names_unique(load_conf(path), cell_size))
+            model.get_result()
+            glb.model = model
+            glb.main_window.refresh(new_file=True, simulate=False)
+            for name, setup, func in operations(path, model):
+                if name in skip:
+                    continue
+                samples = measure(func, setup, repeat, budget)
+                results.append({'operation': name, 'elements': size, 'samples': samples,
+                                'min': min(samples), 'median': statistics.median(samples)})
+                print('{:>8} {:<24}{:10.4f} s'.format(size, name, min(samples)), file=sys.stderr, flush=True)
+
+    glb.main_window.sim_worker.stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run',
+                                     description='Time FLAME-GUI operations on synthetic lattices.')
+    parser.add_argument('-o', '--output', help='JSON result file (default: standard output)')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=SIZES, help='lattice sizes in elements')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='samples per operation')
+    parser.add_argument('-b', '--budget', type=float, default=10.0,
+                        help='seconds after which an operation is not sampled again')
+    parser.add_argument('--skip', nargs='+', default=[], help='operations not to run')
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    results = run_benchmarks(args.sizes, args.repeat, args.budget, args.skip)
+    report = {'format': FORMAT_VERSION,
+              'created': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+              'environment': environment(),
+              'repeat': args.repeat,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+import argparse
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+from classes.lattice import open_model
+from classes.model import serialize_model
+from classes.optimization import apply_knobs, optimize, span_start
+
+# a job file lists tasks sharing the keys given at its top level, e.g.
+# {"lattice": "PS_demo.lat",
+#  "tasks": [{"type": "run", "parameters": ["xrms", "yrms"]},
+#            {"type": "sweep", "location": "FS_F1S2:PM_D1458",
+#             "knobs": [{"element": "FS_F1S1:Q_D1013", "attribute": "B2", "values": {"start": 0, "stop": 1, "num": 11}}]},
+#            {"type": "optimize", "method": "Nelder-Mead", "knobs": {"FS_F1S1:Q_D1013": "B2"},
+#             "location": "FS_F1S2:PM_D1458", "target": {"xrms": [1.0, 1.0]}}]}
+TASK_DEFAULTS = {'parameters': ['xrms', 'yrms'],
+                 'cache_size': 10000,
+                 'cache_tol': 1e-9}
+
+
+def load_job(path):
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            job = yaml.safe_load(f)
+        else:
+            job = json.load(f)
+    if not job.get('tasks'):
+        raise ValueError(path + ' has no tasks')
+    return job
+
+
+def prepare_tasks(job, job_dir, output):
+    # every task gets the job-level keys, a unique name and absolute paths
+    shared = {k: v for k, v in job.items() if k not in ('tasks', 'output', 'workers')}
+    tasks = []
+    for i, task in enumerate(job['tasks']):
+        task = dict(TASK_DEFAULTS, **dict(shared, **task))
+        task.setdefault('name', '{}_{}'.format(task.get('type', 'task'), i))
+        if 'lattice' not in task:
+            raise ValueError('task ' + task['name'] + ' has no lattice')
+        task['lattice'] = os.path.join(job_dir, task['lattice'])
+        task['output'] = os.path.join(output, task['name'])
+        tasks.append(task)
+    names = [task['name'] for task in tasks]
+    if len(set(names)) != len(names):
+        raise ValueError('task names must be unique')
+    return tasks
+
+
+def load_model(task):
+    model = open_model(task['lattice'])
+    for element, properties in task.get('set', {}).items():  # edits applied before the task
+        model.reconfigure(element, properties)
+    return model
+
+
+def check_elements(model, names):
+    for name in names:
+        if not model.has_element_name(name):
+            raise ValueError('no element named ' + name)
+
+
+def location_index(model, location):
+    if location is None:
+        return len(model.machine) - 1
+    if isinstance(location, str):
+        check_elements(model, [location])
+        return model.get_indexes_by_name(location)[0]
+    index = int(location)
+    if not 0 <= index < len(model.machine):
+        raise ValueError('location {} is outside the lattice of {} elements'.format(index, len(model.machine)))
+    return index
+
+
+def target_index(model, knobs, location, task_type):
+    # index of a task's location (default: the last element), which must not be upstream of a knob
+    index = location_index(model, location)
+    if any(i > index for name in knobs for i in model.get_indexes_by_name(name)[:1]):
+        raise ValueError('the {} location must be at or beyond every knob'.format(task_type))
+    return index
+
+
+def knob_values(values):
+    # a list of values or {"start", "stop", "num"} for evenly spaced ones
+    if isinstance(values, dict):
+        return np.linspace(values['start'], values['stop'], int(values['num']))
+    return np.asarray(values, dtype=float)
+
+
+def run_lattice(task):
+    model = load_model(task)
+    result = model.get_result()
+    names = np.array([p['name'] for p in model.get_element_index().properties])
+    columns = {k: result[k] for k in ['pos'] + list(task['parameters'])}
+    np.savez(task['output'] + '.npz', index=result.index, name=names[result.index], **columns)
+    return [task['output'] + '.npz']
+
+
+def run_sweep(task):
+    # every combination of the knob values, simulated from the first knob to the location only
+    model = load_model(task)
+    knobs = {k['element']: k['attribute'] for k in task['knobs']}
+    check_elements(model, knobs)
+    values = [knob_values(k['values']) for k in task['knobs']]
+    location = target_index(model, knobs, task.get('location'), 'sweep')
+
+    start = span_start(model, knobs)
+    grid = np.array(list(itertools.product(*values)), dtype=float)
+    results = {p: np.empty(len(grid)) for p in task['parameters']}
+    for n, x in enumerate(grid):
+        apply_knobs(model, knobs, x)
+        if start is None:
+            r, s = model.run(to_element=location)
+        else:
+            r, s = model.run(bmstate=start[1], from_element=start[0], to_element=location)
+        for p in task['parameters']:
+            results[p][n] = getattr(s, p)
+
+    columns = {'{}.{}'.format(k['element'], k['attribute']): grid[:, j] for j, k in enumerate(task['knobs'])}
+    np.savez(task['output'] + '.npz', **columns, **results)
+    return [task['output'] + '.npz']
+
+
+def run_optimization(task):
+    import multiprocessing as mp
+    from queue import SimpleQueue
+
+    model = load_model(task)
+    knobs = dict(task['knobs'])
+    check_elements(model, knobs)
+    obj = {'location': target_index(model, knobs, task.get('location'), 'optimization'), 'target': task['target']}
+    method = task.get('method', 'Nelder-Mead')
+    if method == 'Nelder-Mead':
+        x0 = task.get('x0') or [model.get_element_by_name(n)['properties'][a] for n, a in knobs.items()]
+        problem = {'method': method, 'x0': x0}
+    else:
+        problem = {'method': method, 'bounds': [tuple(b) for b in task['bounds']],
+                   'vectorized': task.get('vectorized', True)}
+    # a task running in the job's pool cannot start a pool of its own
+    workers = 1 if mp.current_process().daemon else task.get('workers', 1)
+    problem.update({'conf': serialize_model(model), 'knobs': knobs, 'obj': obj,
+                    'workers': workers,
+                    'maxiter': task.get('maxiter'),
+                    'cache_size': task['cache_size'],
+                    'cache_tol': task['cache_tol']})
+
+    queue = SimpleQueue()
+    optimize(problem, queue, None)
+    history = []
+    while not queue.empty():
+        msg = queue.get()
+        if msg[0] == 'progress':
+            history.append(msg[1:3])
+    if msg[0] == 'error':
+        raise RuntimeError(msg[1])
+
+    status, best_x, best_cost, summary, cache_stats = msg
+    apply_knobs(model, knobs, best_x)
+    model.generate_latfile(latfile=task['output'] + '.lat')
+    with open(task['output'] + '.json', 'w') as f:
+        json.dump({'status': status, 'knobs': knobs, 'x': best_x, 'cost': best_cost,
+                   'history': history, 'cache': cache_stats, 'summary': summary}, f, indent=2)
+    return [task['output'] + '.json', task['output'] + '.lat']
+
+
+TASK_TYPES = {'run': run_lattice,
+              'sweep': run_sweep,
+              'optimize': run_optimization}
+
+
+def run_task(task):
+    # pool entry point; failures are reported in the summary rather than stopping the job
+    t = time.perf_counter()
+    try:
+        files = TASK_TYPES[task['type']](task)
+        status, message = 'ok', ''
+    except Exception as e:
+        files, status, message = [], 'error', '{}: {}'.format(type(e).__name__, e)
+    return {'name': task['name'], 'type': task.get('type'), 'status': status, 'message': message,
+            'files': files, 'seconds': time.perf_counter() - t}
+
+
+def run_job(path, output=None, workers=None):
+    import multiprocessing as mp
+
+    job = load_job(path)
+    job_dir = os.path.dirname(os.path.abspath(path))
+    if output is None:
+        output = os.path.join(job_dir, job.get('output') or os.path.splitext(os.path.basename(path))[0] + '_results')
+    os.makedirs(output, exist_ok=True)
+    tasks = prepare_tasks(job, job_dir, output)
+    workers = min(workers or job.get('workers') or os.cpu_count() or 1, len(tasks))
+
+    results = []
+    if workers > 1:
+        with mp.get_context('spawn').Pool(workers) as pool:
+            for result in pool.imap_unordered(run_task, tasks):
+                print_result(result)
+                results.append(result)
+    else:
+        for task in tasks:
+            results.append(run_task(task))
+            print_result(results[-1])
+
+    order = {task['name']: i for i, task in enumerate(tasks)}
+    results.sort(key=lambda result: order[result['name']])
+    with open(os.path.join(output, 'summary.json'), 'w') as f:
+        json.dump({'job': os.path.abspath(path), 'tasks': results}, f, indent=2)
+    return results
+
+
+def print_result(result):
+    line = '{:<8} {} ({:.2f} s)'.format(result['status'], result['name'], result['seconds'])
+    if result['message']:
+        line += ': ' + result['message']
+    print(line, flush=True)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='main.py batch', description='Run FLAME-GUI jobs without the GUI.')
+    parser.add_argument('job', help='JSON or YAML job file')
+    parser.add_argument('-o', '--output', help='result directory (default: from the job file)')
+    parser.add_argument('-j', '--workers', type=int, help='tasks run in parallel (default: one per CPU)')
+    args = parser.parse_args(argv)
+
+    results = run_job(args.job, output=args.output, workers=args.workers)
+    return 0 if all(result['status'] == 'ok' for result in results) else 1
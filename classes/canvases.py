@@ -1,23 +1,119 @@
 import globals as glb
 import matplotlib.patches as mpatches
 import numpy as np
-from flame_utils import PlotLat
 from matplotlib.backends.backend_qtagg import FigureCanvas
-import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.colors import to_rgba_array
+from matplotlib.lines import Line2D
+from matplotlib.transforms import Affine2D
 
+from classes.profiling import timed
 from classes.utility import Line
 
+# element colors of the lattice layout, as drawn by flame_utils.PlotLat
+LAYOUT_COLORS = {'rfcavity': 'orange',
+                 'solenoid': 'red',
+                 'quadrupole': 'purple',
+                 'sextupole': 'navy',
+                 'sbend': 'green',
+                 'equad': 'blue',
+                 'edipole': 'lime',
+                 'bpm': 'm',
+                 'orbtrim': 'black',
+                 'stripper': 'y',
+                 'marker': 'c'}
+
+
+def layout_strength(properties):
+    # the strength whose sign sets which way an element is drawn (flame_utils.PlotLat._get_scl)
+    get = properties.get
+    element_type = properties['type']
+    if element_type == 'rfcavity':
+        return get('scl_fac', 0.0) * np.cos(2.0 * np.pi * get('phi', 0.0) / 360.0)
+    elif element_type == 'solenoid':
+        return get('B', 0.0)
+    elif element_type == 'quadrupole':
+        return get('B2', 1.0)
+    elif element_type == 'sextupole':
+        return get('B3', 0.0)
+    elif element_type in ('sbend', 'edipole'):
+        return get('phi', 0.0)
+    elif element_type == 'equad':
+        return get('V', 0.0) / get('radius', 1.0)**2
+    return 0.0
+
+
+class LatticeLayout:
+    # the layout strip of a lattice, built at a center of 0 and a scale of 1: a rectangle per element
+    # with a length and a tick per thin element, so its artists are only moved by a transform afterwards
+    def __init__(self, model):
+        self.revision = model.layout_revision
+        rects, rect_colors, ticks, tick_colors = [], [], [], []
+        pos = 0.0
+        for properties in model.get_element_index().properties:
+            dL = properties.get('L', 0.0)
+            color = LAYOUT_COLORS.get(properties['type'])
+            if color is not None:
+                if dL != 0.0:
+                    if properties['type'] in ('rfcavity', 'solenoid'):
+                        bottom, height = -0.7, 1.4
+                    else:
+                        bottom, height = 0.0, np.sign(layout_strength(properties))
+                    rects.append((pos, bottom, dL, height))
+                    rect_colors.append(color)
+                else:
+                    ticks.append(pos)
+                    tick_colors.append(color)
+            pos += dL
+        self.length = pos
+
+        x, y, w, h = np.array(rects, dtype=float).reshape(-1, 4).T
+        self.verts = np.stack([np.stack([x, y], axis=1), np.stack([x + w, y], axis=1),
+                               np.stack([x + w, y + h], axis=1), np.stack([x, y + h], axis=1)], axis=1)
+        self.rect_colors = to_rgba_array(rect_colors) if rect_colors else np.empty((0, 4))
+        ticks = np.array(ticks, dtype=float)
+        self.segments = np.stack([np.stack([ticks, np.full_like(ticks, -0.3)], axis=1),
+                                  np.stack([ticks, np.full_like(ticks, 0.3)], axis=1)], axis=1)
+        self.tick_colors = to_rgba_array(tick_colors) if tick_colors else np.empty((0, 4))
+
+    def create_artists(self):
+        rects = PolyCollection(self.verts, facecolors=self.rect_colors, edgecolors='none')
+        ticks = LineCollection(self.segments, colors=self.tick_colors)
+        axis = Line2D([0.0, self.length], [0.0, 0.0], color='gray', zorder=-5)
+        bounds = Line2D([0.0, self.length], [-1.0, 1.0], visible=False)  # the strip's extent, for autoscaling
+        return [rects, ticks, axis, bounds]
+
 
 class MainCanvas(FigureCanvas):
+    # with blit, the parameter lines are animated artists drawn over a saved background, so a data
+    # update that keeps the axis limits only redraws the lines; anything else is a full draw
+    use_blit = True
+    rescale_shrink = 0.5  # a full draw also follows when a line's y span shrinks below this share
+
     def __init__(self):
         super().__init__()
-        self.colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728']
+        self.colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
+                       '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
+        self.stacked = False  # one panel per unit above a layout strip, instead of overlaid twin axes
         self.base_ax = None
+        self.layout_ax = None  # the layout strip of the stacked panels
         self.axes = []
         self.lines = {}
         self.custom_colors = {}
+        self.location_key = None  # (layout revision, y range) the lattice layout was drawn for
+        self.layout = None  # LatticeLayout of the last lattice drawn
+        self.location_artists = []
+        self.background = None  # figure without the lines, saved after every full draw
+        self.drawn_spans = {}  # param -> (ymin, ymax) at the last full draw
+
+        self.mpl_connect('draw_event', self.onDraw)
 
+    @timed('MainCanvas.plotParameter')
     def plotParameter(self, param):
+        if self.stacked:
+            self.showParameters(list(self.lines) + [param])
+            return
+
         param_unit = glb.model.get_parameter_unit(param)
         ax = self.getAxisWithYLabel(param_unit)
         ln = self.createLine(param)
@@ -31,7 +127,7 @@ class MainCanvas(FigureCanvas):
                 self.base_ax.set_xlabel('pos [m]')
             else:
                 ax = self.base_ax.twinx()
-                self.setAxisLocation(ax)
+                self.setAxisLocation(ax, len(self.axes))
                 base_xmargin, _ = self.base_ax.margins()
                 ax.margins(base_xmargin, 0.425)
             ax.add_line(ln)
@@ -53,95 +149,44 @@ class MainCanvas(FigureCanvas):
         self.draw_idle()
         
     def removeParameter(self, param):
-        self.lines[param].remove()
-        self.lines.pop(param)
-        self.removeLegend()
-        self.removeLocation()
-        
-        for ax in self.axes:
-            if len(ax.lines) == 0:
-                if ax == self.base_ax:
-                    if len(self.axes) == 1:
-                        self.base_ax = None
-                        ax.remove()
-                        self.axes.remove(ax)
-                        del ax  # because any left over reference will remain on the canvas: https://stackoverflow.com/questions/4981815/how-to-remove-lines-in-a-matplotlib-plot
-                    else:
-                        above_axis = self.axes[1]
-                        for ln in above_axis.get_lines():
-                            above_axis.lines.remove(ln)
-                            n_ln = self.createLine(list(self.lines.keys())[list(self.lines.values()).index(ln)]) # getting 'dict' key from value
-                            self.base_ax.add_line(n_ln)
-                            self.lines[n_ln.param] = n_ln
-                            del ln  # necessary
-
-                        y_unit = above_axis.yaxis.get_label().get_text()
-                        self.base_ax.set_ylabel(y_unit)
-                        above_axis.remove()
-                        self.axes.remove(above_axis)
-                        del above_axis
-                else:
-                    ax.remove()
-                    self.axes.remove(ax)
-                    del ax  # necessary
-
-        self.updateAxisLocation()
+        self.showParameters([p for p in self.lines if p != param])
 
-        for ax in self.axes:
-            ax.relim()
-            ax.autoscale()
-
-        if len(self.axes) != 0:  # no axes = no legend
-            self.createLegend()
-
-        self.plotLocation()
-
-        self.figure.tight_layout()
-        self.draw_idle()
-            
     def getAxisWithYLabel(self, y_label):
         for ax in self.axes:
             if y_label == ax.get_ylabel():
                 return ax
         return None
     
-    def setAxisLocation(self, axis):
-        if len(self.axes) == 1:
-            axis.yaxis.set_ticks_position('right')
-            axis.spines.left.set_position(('outward', 0))
-            axis.spines.right.set_position(('outward', 0))
-            axis.yaxis.set_label_position('right')
-        elif len(self.axes) == 2:
-            axis.yaxis.set_ticks_position('left')
-            axis.spines.left.set_position(('outward', 70))
-            axis.spines.right.set_position(('outward', 0))
-            axis.yaxis.set_label_position("left")
-        else:
-            axis.yaxis.set_ticks_position('right')
-            axis.spines.left.set_position(('outward', 0))
-            axis.spines.right.set_position(('outward', 70))
-            axis.yaxis.set_label_position('right')
-    
+    def setAxisLocation(self, axis, index):
+        # overlaid axes alternate left and right, every pair further out
+        side = 'left' if index % 2 == 0 else 'right'
+        other = 'right' if side == 'left' else 'left'
+        axis.yaxis.set_ticks_position(side)
+        axis.spines[side].set_position(('outward', 70 * (index // 2)))
+        axis.spines[other].set_position(('outward', 0))
+        axis.yaxis.set_label_position(side)
+
     def createLine(self, param):
-        r, _ = glb.model.run(monitor='all')
-        data = glb.model.collect_data(r, 'pos', param)
-        ln = Line(data['pos'], data[param], param)
+        result = glb.model.get_result()
+        ln = Line(result.pos, result[param], param)
         ln.set_label(param)
+        ln.set_animated(self.use_blit)
         if param in glb.model.get_prime_parameters():
             ln.set_linestyle('dashed')
         self.setLineColor(param, ln)
         return ln
 
     def createLegend(self):
-        patches = []
-        topmost_ax = self.axes[-1]
-        for ax in self.axes:
-            for ln in ax.lines:
-                if isinstance(ln, Line):
-                    patch = mpatches.Patch(color=ln.get_color(), label=ln.get_label())
-                    patches.append(patch)
-        legend = topmost_ax.legend(handles=patches, loc='upper left')
-        legend.set_draggable(True)
+        # one legend on the topmost of the overlaid axes, or one per stacked panel
+        for group in ([[ax] for ax in self.axes] if self.stacked else [self.axes]):
+            patches = []
+            for ax in group:
+                for ln in ax.lines:
+                    if isinstance(ln, Line):
+                        patch = mpatches.Patch(color=ln.get_color(), label=ln.get_label())
+                        patches.append(patch)
+            legend = group[-1].legend(handles=patches, loc='upper left')
+            legend.set_draggable(True)
 
     def removeLegend(self):
         if len(self.axes) > 1:  # new axis just added
@@ -155,92 +200,126 @@ class MainCanvas(FigureCanvas):
         taken = []
         for ln in self.lines.values():
             taken.append(ln.get_color())
-        available = list(set(self.colors) - set(taken))
-        n_color = available[0]
+        available = [color for color in self.colors if color not in taken]
+        n_color = available[0] if available else self.colors[len(self.lines) % len(self.colors)]
 
         if param not in self.custom_colors:
             line.set_color(n_color)
         else:
             line.set_color(self.custom_colors[param])
 
-    def updateAxisLocation(self):
-        for i in range(len(self.axes)):
-            axis = self.axes[i]
-            if i == 0:
-                axis.yaxis.set_ticks_position('left')
-                axis.spines.left.set_position(('outward', 0))
-                axis.spines.right.set_position(('outward', 0))
-                axis.yaxis.set_label_position('left')
-            elif i == 1:
-                axis.yaxis.set_ticks_position('right')
-                axis.spines.left.set_position(('outward', 0))
-                axis.spines.right.set_position(('outward', 0))
-                axis.yaxis.set_label_position('right')
-            elif i == 2:
-                axis.yaxis.set_ticks_position('left')
-                axis.spines.left.set_position(('outward', 70))
-                axis.spines.right.set_position(('outward', 0))
-                axis.yaxis.set_label_position("left")
-            else:
-                axis.yaxis.set_ticks_position('right')
-                axis.spines.left.set_position(('outward', 0))
-                axis.spines.right.set_position(('outward', 70))
-                axis.yaxis.set_label_position('right')
-
+    @timed('MainCanvas.plotLocation')
     def plotLocation(self):
+        # the layout is built once per layout revision and then only positioned below the lowest axis's
+        # lines, or drawn at full height in the layout strip of the stacked panels
         if self.base_ax:
-            ymax, ymin = self.getYMaxMin(self.base_ax)
-            yrange = ymax - ymin
-            frac_yrange = yrange * 0.1
-
-            if ymax != ymin:  # not a horizonal line
-                ycen_eq = ymin - frac_yrange - frac_yrange * 0.5
-                yscl_eq = frac_yrange
+            ax = self.layout_ax if self.stacked else self.base_ax
+            if self.stacked:
+                ycen_eq, yscl_eq = 0.0, 1.0
             else:
-                ycen_eq = ymax - 1
-                yscl_eq = 1 * 0.09
+                ymax, ymin = self.getYMaxMin(self.base_ax)
+                yrange = ymax - ymin
+                frac_yrange = yrange * 0.1
 
-            lattice = PlotLat(glb.model.machine, auto_scaling=False, starting_offset=0)
-            lattice.generate(ycen=ycen_eq, yscl=yscl_eq, legend=False, option=False, axes=self.base_ax)  # locational plot created
+                if ymax != ymin:  # not a horizonal line
+                    ycen_eq = ymin - frac_yrange - frac_yrange * 0.5
+                    yscl_eq = frac_yrange
+                else:
+                    ycen_eq = ymax - 1
+                    yscl_eq = 1 * 0.09
+
+            if self.layout is None or self.layout.revision != glb.model.layout_revision:
+                self.layout = LatticeLayout(glb.model)
+                self.removeLocation()
+            if not self.location_artists or self.location_artists[0].axes is not ax:
+                self.removeLocation()
+                self.location_artists = self.layout.create_artists()
+                ax.add_collection(self.location_artists[0], autolim=False)
+                ax.add_collection(self.location_artists[1], autolim=False)
+                ax.add_line(self.location_artists[2])
+                ax.add_line(self.location_artists[3])
+
+            transform = Affine2D().scale(1.0, yscl_eq).translate(0.0, ycen_eq) + ax.transData
+            for artist in self.location_artists:
+                artist.set_transform(transform)
+            self.location_key = self.locationKey()
 
-            self.base_ax.relim()
-            self.base_ax.autoscale_view(True, True, True)
+            ax.relim()
+            ax.autoscale_view(True, True, True)
 
-    def removeLocation(self):
-        if self.base_ax:
-            for ln in reversed(self.base_ax.lines):  # reversed necessary
-                if not isinstance(ln, Line):
-                    ln.remove()
-            [p.remove() for p in reversed(self.base_ax.patches)]  # reversed necessary
+    def locationKey(self, result=None):
+        # what the layout was positioned for: the lattice, and the y range of the lowest axis when overlaid;
+        # with a result, the y range its data gives the lines of the lowest axis
+        if self.base_ax is None:
+            return None
+        if self.stacked:
+            return (glb.model.layout_revision,)
+        if result is None:
+            ymax, ymin = self.getYMaxMin(self.base_ax)
+        else:
+            ydata = [result[param] for param, ln in self.lines.items() if ln.axes is self.base_ax]
+            ymax = max([np.max(y) for y in ydata], default=-np.inf)
+            ymin = min([np.min(y) for y in ydata], default=np.inf)
+        return (glb.model.layout_revision, ymax, ymin)
 
-            self.base_ax.relim()
-            self.base_ax.autoscale_view(True, True, True)
+    def removeLocation(self):
+        self.location_key = None
+        for artist in self.location_artists:
+            if artist.axes is not None:
+                artist.remove()
+        self.location_artists = []
+        for ax in (self.base_ax, self.layout_ax):
+            if ax:
+                ax.relim()
+                ax.autoscale_view(True, True, True)
 
     def getYMaxMin(self, axis):
         ymax = -np.inf
         ymin = np.inf
         for ln in axis.lines:
             if isinstance(ln, Line):
-                ydata = ln.get_ydata()
-                ln_ymax = max(ydata)
-                ln_ymin = min(ydata)
+                ydata = ln.full_y
+                ln_ymax = np.max(ydata)
+                ln_ymin = np.min(ydata)
                 if ln_ymax > ymax:
                     ymax = ln_ymax
                 if ln_ymin < ymin:
                     ymin = ln_ymin
         return ymax, ymin
 
+    @timed('MainCanvas.refresh')
     def refresh(self):
+        # the axes and lines are kept and given the latest result, unless the set of units changed
+        param_select = self.parent().parent().parent().parent().param_select
+        active_items = param_select.getCheckedItems(param_select.invisibleRootItem())
+        params = [param_select.convertItemIntoParam(item) for item in active_items]
+        self.showParameters(params)
+
+    def showParameters(self, params):
+        units = {glb.model.get_parameter_unit(param) for param in params}
+        if units == {ax.get_ylabel() for ax in self.axes}:
+            self.updateLines(params)
+        else:
+            self.rebuild(params)
+
+    def setStacked(self, stacked):
+        self.stacked = stacked
+        self.rebuild(list(self.lines))
+
+    def rebuild(self, params):
         self.figure.clear()
         self.axes.clear()
         self.lines.clear()
         self.base_ax = None
-        
-        param_select = self.parent().parent().parent().parent().param_select
-        active_items = param_select.getCheckedItems(param_select.invisibleRootItem())
-        for item in active_items:
-            param = param_select.convertItemIntoParam(item)
-            self.plotParameter(param)
+        self.layout_ax = None
+        self.location_key = None
+        self.location_artists = []
+
+        if self.stacked:
+            self.createPanels(params)
+        else:
+            for param in params:
+                self.plotParameter(param)
 
         for ax in self.axes:
             ax.relim()
@@ -249,9 +328,120 @@ class MainCanvas(FigureCanvas):
         self.figure.tight_layout()
         self.draw_idle()
 
+    def createPanels(self, params):
+        # a panel per unit in order of appearance, sharing the x axis with the layout strip below them
+        units = list(dict.fromkeys(glb.model.get_parameter_unit(param) for param in params))
+        if not units:
+            return
+        axes = self.figure.subplots(len(units) + 1, 1, sharex=True, squeeze=False,
+                                    gridspec_kw={'height_ratios': [4] * len(units) + [1]})[:, 0]
+        self.axes.extend(axes[:-1])
+        self.base_ax, self.layout_ax = axes[0], axes[-1]
+        for ax, unit in zip(self.axes, units):
+            ax.set_ylabel(unit)
+        self.layout_ax.set_xlabel('pos [m]')
+        self.layout_ax.set_yticks([])
+
+        for param in params:
+            ln = self.createLine(param)
+            self.getAxisWithYLabel(glb.model.get_parameter_unit(param)).add_line(ln)
+            self.lines[param] = ln
+        self.createLegend()
+        self.plotLocation()
+
+    @timed('MainCanvas.updateLines')
+    def updateLines(self, params):
+        result = glb.model.get_result()
+        blit = self.canBlit(params, result)
+        changed = False
+        for param in [param for param in self.lines if param not in params]:
+            self.lines.pop(param).remove()
+            changed = True
+        for param in params:
+            if param in self.lines:
+                self.lines[param].set_data(result.pos, result[param])
+            else:
+                ln = self.createLine(param)
+                self.getAxisWithYLabel(glb.model.get_parameter_unit(param)).add_line(ln)
+                self.lines[param] = ln
+                changed = True
+
+        if blit:
+            self.blitLines()
+            return
+
+        if changed:
+            for ax in self.axes:
+                if ax.get_legend():
+                    ax.get_legend().remove()
+            if self.axes:
+                self.createLegend()
+
+        # the lattice layout follows the lattice and, when overlaid, the y range of the lowest axis
+        if self.location_key != self.locationKey():
+            self.plotLocation()
+
+        for ax in self.axes:
+            ax.relim()
+            ax.autoscale()
+        self.draw_idle()
+
+    def canBlit(self, params, result):
+        # true if the new data fits the current view, so the saved background is still valid
+        if not self.use_blit or self.background is None or self.location_key is None:
+            return False
+        if set(params) != set(self.lines) or self.location_key != self.locationKey(result):
+            return False
+        if self.background_size != tuple(self.figure.bbox.size):  # resized, not drawn yet
+            return False
+        if len(result.pos) == 0 or tuple(self.base_ax.get_xlim()) != self.drawn_xlim:
+            return False
+        for param, ln in self.lines.items():
+            ydata = result[param]
+            ymin, ymax = np.min(ydata), np.max(ydata)
+            low, high = ln.axes.get_ylim()
+            drawn_min, drawn_max = self.drawn_spans.get(param, (ymin, ymax))
+            if not (low <= ymin and ymax <= high):  # also false for NaN
+                return False
+            if ymax - ymin < self.rescale_shrink * (drawn_max - drawn_min):
+                return False
+        return True
+
+    def print_figure(self, *args, **kwargs):
+        # a saved figure leaves animated artists out, so the lines are drawn as ordinary artists meanwhile
+        for ln in self.lines.values():
+            ln.set_animated(False)
+        try:
+            return super().print_figure(*args, **kwargs)
+        finally:
+            for ln in self.lines.values():
+                ln.set_animated(self.use_blit)
+
+    def blitLines(self):
+        self.restore_region(self.background)
+        self.drawLines()
+        self.blit(self.figure.bbox)
+
+    def drawLines(self):
+        for ln in self.lines.values():
+            ln.axes.draw_artist(ln)
+
+    def onDraw(self, event):
+        # after a full draw: save the figure without the animated lines, then draw them on top;
+        # draws for a saved file go to another renderer and leave the screen alone
+        if not self.use_blit or event.canvas is not self or self.figure.canvas.is_saving():
+            return
+        self.background = self.copy_from_bbox(self.figure.bbox)
+        self.background_size = tuple(self.figure.bbox.size)
+        self.drawn_xlim = tuple(self.base_ax.get_xlim()) if self.base_ax else None
+        self.drawn_spans = {param: (np.min(ln.full_y), np.max(ln.full_y)) for param, ln in self.lines.items()}
+        self.drawLines()
+
 
 class PhaseSpaceCanvas(FigureCanvas):
     def __init__(self):
+        import matplotlib.pyplot as plt
+
         super().__init__()
         plt.subplots_adjust(left=2.0, right=2.1, top=2.1, bottom=2.0)
         subplots = self.figure.subplots(1, 2)
@@ -269,10 +459,10 @@ class PhaseSpaceCanvas(FigureCanvas):
         self.right_subplot.set_ylabel('yp [mrad]')
         self.figure.tight_layout()
         
+    @timed('PhaseSpaceCanvas.plotElement')
     def plotElement(self, element_name):
-        r, _ = glb.model.run(monitor='all')
-        data = glb.model.collect_data(r, 'xcen', 'ycen', 'xpcen', 'ypcen', 'xtwsa', 'ytwsa', 'xtwsb', 'ytwsb', 'xeps', 'yeps')
-        idx = glb.model.find(element_name)[0]
+        data = glb.model.get_result()
+        idx = glb.model.get_indexes_by_name(element_name)[0]
         
         # 'x' graph
         el, x_res = self.phaseEllipse(data, idx, 'x', edgecolor='b')
@@ -322,4 +512,31 @@ class PhaseSpaceCanvas(FigureCanvas):
         twsb = d[coor + 'twsb'][idx]
         eps = d[coor + 'eps'][idx]
         cov = self.tws2cov(twsa, twsb, eps)
-        return self.ellipse(cen, cov, **kws), np.array([cen[0], cen[1], twsa, twsb, eps])
\ No newline at end of file
+        return self.ellipse(cen, cov, **kws), np.array([cen[0], cen[1], twsa, twsb, eps])
+
+class ConvergenceCanvas(FigureCanvas):
+    def __init__(self):
+        super().__init__()
+        self.ax = self.figure.subplots()
+        self.ax.set_xlabel('iteration')
+        self.ax.set_ylabel('best cost')
+        self.ax.set_yscale('log')
+        self.ax.grid()
+        self.line, = self.ax.plot([], [], color='#1f77b4')
+        self.iterations = []
+        self.costs = []
+        self.figure.tight_layout()
+
+    def clear(self):
+        self.iterations = []
+        self.costs = []
+        self.line.set_data([], [])
+        self.draw_idle()
+
+    def addPoint(self, iteration, cost):
+        self.iterations.append(iteration)
+        self.costs.append(max(cost, np.finfo(float).tiny))  # log scale
+        self.line.set_data(self.iterations, self.costs)
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.draw_idle()
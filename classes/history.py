@@ -0,0 +1,191 @@
+import numpy as np
+from flame import Machine
+
+
+def state_nbytes(state):
+    return sum(np.asarray(getattr(state.state, k)).nbytes for k in state.state)
+
+
+def states_equal(a, b):
+    # 'next_elem' is propagation bookkeeping and is reset by clone()
+    return all(np.array_equal(getattr(a.state, k), getattr(b.state, k)) for k in a.state if k != 'next_elem')
+
+
+def nbytes(obj):
+    # rough memory footprint of journal entries
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(nbytes(k) + nbytes(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    if isinstance(obj, str):
+        return len(obj)
+    return 8
+
+
+class Step:
+    # one undoable user action: element operations as (forward calls, inverse calls) pairs,
+    # where a call is (Model method name, kwargs), plus the beam state before/after if it changed
+    def __init__(self, position, bmstate):
+        self.position = position  # number of steps applied before this one
+        self.ops = []
+        self.bmstate_before = bmstate
+        self.bmstate_after = None
+        self.nbytes = state_nbytes(bmstate)
+
+    def add(self, forward, inverse):
+        self.ops.append((forward, inverse))
+        self.nbytes += nbytes(forward) + nbytes(inverse)
+
+    def close(self, model):
+        # keep the beam states only if the step changed them
+        if self.bmstate_before is None:
+            return
+        if states_equal(self.bmstate_before, model.bmstate):
+            self.nbytes -= state_nbytes(self.bmstate_before)
+            self.bmstate_before = None
+        else:
+            self.bmstate_after = model.bmstate.clone()
+            self.nbytes += state_nbytes(self.bmstate_after)
+
+    def is_empty(self):
+        return not self.ops and self.bmstate_before is None
+
+
+class History:
+    # undo/redo journal of model deltas; a full snapshot is kept every 'snapshot_every' steps
+    # to recover from a failing inverse, and the oldest steps are dropped beyond 'max_bytes'
+    def __init__(self, max_bytes=64 * 2**20, snapshot_every=50):
+        self.max_bytes = max_bytes
+        self.snapshot_every = snapshot_every
+        self.model = None
+        self.steps = []  # undo stack, the last one may still be open
+        self.redo_steps = []
+        self.snapshots = {}  # position -> (lattice config, beam state, size)
+        self.position = 0
+        self.open = False
+        self.replaying = False
+
+    def attach(self, model):
+        if self.model is not None:
+            self.model.journal = None
+        self.clear()
+        self.model = model
+        model.journal = self
+
+    def clear(self):
+        self.steps.clear()
+        self.redo_steps.clear()
+        self.snapshots.clear()
+        self.position = 0
+        self.open = False
+
+    def begin(self, model):
+        # start a new step; operations recorded until the next begin() belong to it
+        if model is not self.model:
+            self.attach(model)
+        self.close()
+
+        if self.position % self.snapshot_every == 0 and self.position not in self.snapshots:
+            conf = model.clone_machine().conf()  # Machine.conf() misses reconfigure() edits
+            self.snapshots[self.position] = (conf, model.bmstate.clone(), nbytes(conf))
+        self.steps.append(Step(self.position, model.bmstate.clone()))
+        if self.redo_steps:  # snapshots past this point belong to the discarded branch
+            self.redo_steps.clear()
+            for p in [p for p in self.snapshots if p > self.position]:
+                del self.snapshots[p]
+        self.open = True
+        self.enforce_limit()
+
+    def close(self):
+        if not self.open:
+            return
+        self.open = False
+        step = self.steps[-1]
+        step.close(self.model)
+        if step.is_empty():
+            self.steps.pop()
+        else:
+            self.position += 1
+
+    def record(self, forward, inverse):
+        if self.replaying:
+            return
+        if not self.open:  # an edit made without begin() joins a step of its own
+            self.begin(self.model)
+        self.steps[-1].add(forward, inverse)
+
+    def can_undo(self):
+        return bool(self.steps)
+
+    def can_redo(self):
+        return bool(self.redo_steps)
+
+    def undo(self):
+        self.close()
+        if not self.steps:
+            return
+        step = self.steps.pop()
+        try:
+            self.replay([call for forward, inverse in reversed(step.ops) for call in inverse])
+            if step.bmstate_before is not None:
+                self.model.bmstate = step.bmstate_before
+        except Exception as e:
+            print('Undo failed, restoring snapshot: ' + str(e))
+            self.restore(step.position)
+        self.position -= 1
+        self.redo_steps.append(step)
+
+    def redo(self):
+        self.close()
+        if not self.redo_steps:
+            return
+        step = self.redo_steps.pop()
+        self.apply_forward(step)
+        self.position += 1
+        self.steps.append(step)
+
+    def apply_forward(self, step):
+        self.replay([call for forward, inverse in step.ops for call in forward])
+        if step.bmstate_after is not None:
+            self.model.bmstate = step.bmstate_after
+
+    def replay(self, calls):
+        self.replaying = True
+        try:
+            for method, kwargs in calls:
+                getattr(self.model, method)(**kwargs)
+        finally:
+            self.replaying = False
+
+    def restore(self, position):
+        # rebuild the state after 'position' steps from the closest snapshot and the retained steps
+        first = self.steps[0].position if self.steps else position
+        candidates = [p for p in self.snapshots if first <= p <= position]
+        if not candidates:
+            print('No snapshot to restore step ' + str(position))
+            return
+        start = max(candidates)
+        conf, bmstate, size = self.snapshots[start]
+        self.replaying = True
+        try:
+            self.model.machine = Machine(conf)
+            self.model.bmstate = bmstate
+        finally:
+            self.replaying = False
+        for step in self.steps:
+            if start <= step.position < position:
+                self.apply_forward(step)
+
+    def nbytes(self):
+        snapshots = sum(size + state_nbytes(state) for conf, state, size in self.snapshots.values())
+        return snapshots + sum(step.nbytes for step in self.steps + self.redo_steps)
+
+    def enforce_limit(self):
+        # never drops the open step
+        while len(self.steps) > 1 and self.nbytes() > self.max_bytes:
+            self.steps.pop(0)
+            first = self.steps[0].position
+            for p in [p for p in self.snapshots if p < first]:
+                del self.snapshots[p]
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+import flame
+
+from classes.model import Model
+from classes.snapshots import pack_conf, unpack_conf
+
+CACHE_SUFFIX = '.cache'
+CACHE_VERSION = 1
+
+
+def file_digest(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def parse_lattice(filename):
+    # GLPSParser returns (key, value) pairs; relative paths are expanded against the file's directory
+    with open(filename, 'rb') as f:
+        pairs = flame.GLPSParser().parse(f)
+    conf = OrderedDict(pairs)
+    conf['elements'] = [OrderedDict(element) for element in conf['elements']]
+    return conf
+
+
+def read_cache(filename, stat):
+    # (conf, entry to write back); the sidecar is valid if size and mtime are unchanged or,
+    # failing that, if the content hash matches, in which case it is rewritten with the new mtime
+    try:
+        with open(filename + CACHE_SUFFIX, 'rb') as f:
+            entry = pickle.load(f)
+        if entry.get('version') != CACHE_VERSION or entry['size'] != stat.st_size:
+            return None, None
+        if entry['mtime'] == stat.st_mtime_ns:
+            return unpack_conf(entry['conf']), None
+        digest = file_digest(filename)
+        if entry['sha1'] == digest:
+            entry['mtime'] = stat.st_mtime_ns
+            return unpack_conf(entry['conf']), entry
+        return None, None
+    except Exception:  # missing, stale format or unreadable sidecar
+        return None, None
+
+
+def write_cache(filename, stat, conf, entry=None):
+    if entry is None:
+        entry = {'version': CACHE_VERSION,
+                 'size': stat.st_size,
+                 'mtime': stat.st_mtime_ns,
+                 'sha1': file_digest(filename),
+                 'conf': pack_conf(conf)}
+    path = filename + CACHE_SUFFIX
+    # a temp file of its own per writer, as several processes may open the same lattice at once
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                   dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError as e:  # e.g. a read-only lattice directory; opening still works without the cache
+        print('Could not write lattice cache: ' + str(e))
+    finally:
+        if tmp is not None and os.path.exists(tmp):  # not moved into place
+            os.remove(tmp)
+
+
+def load_conf(filename, use_cache=True):
+    # parsed lattice config, read from the sidecar cache when the .lat file is unchanged
+    stat = os.stat(filename)
+    if use_cache:
+        conf, entry = read_cache(filename, stat)
+        if conf is not None:
+            if entry is not None:
+                write_cache(filename, stat, conf, entry)
+            return conf
+    conf = parse_lattice(filename)
+    if use_cache:
+        write_cache(filename, stat, conf)
+    return conf
+
+
+def open_model(filename, use_cache=True):
+    return model_from_conf(load_conf(filename, use_cache))
+
+
+def model_from_conf(conf):
+    if 'Eng_Data_Dir' not in conf:
+        conf['Eng_Data_Dir'] = flame.__file__.replace('__init__.py', 'test/data')
+    return Model(machine=flame.Machine(conf))
@@ -1,12 +1,213 @@
 from flame import Machine
-from flame_utils import ModelFlame
+from flame_utils import BeamState, ModelFlame, generate_source
 from collections import OrderedDict
 import numpy as np
+import bisect
+import itertools
 import os
 
+from classes.profiling import profiler, timed
+
+# every plottable parameter (see globals.data['parameter']) plus the twiss/emittance keys of the phase space plot
+RESULT_KEYS = ['ref_beta', 'ref_bg', 'ref_gamma', 'ref_IonEk', 'ref_IonEs', 'ref_IonQ', 'ref_IonW', 'ref_IonZ',
+               'ref_phis', 'ref_SampleIonK', 'ref_Brho',
+               'xcen', 'ycen', 'zcen', 'xpcen', 'ypcen', 'zpcen',
+               'xrms', 'yrms', 'zrms', 'xprms', 'yprms', 'zprms',
+               'xemittance', 'yemittance', 'zemittance', 'xnemittance', 'ynemittance', 'znemittance',
+               'xtwiss_beta', 'xtwiss_alpha', 'xtwiss_gamma',
+               'ytwiss_beta', 'ytwiss_alpha', 'ytwiss_gamma',
+               'ztwiss_beta', 'ztwiss_alpha', 'ztwiss_gamma',
+               'couple_xy', 'couple_xpy', 'couple_xyp', 'couple_xpyp', 'last_caviphi0',
+               'xtwsa', 'ytwsa', 'ztwsa', 'xtwsb', 'ytwsb', 'ztwsb', 'xeps', 'yeps', 'zeps']
+
+
+class SimulationResult:
+    # Column store of a full monitored run: 'data' holds one contiguous float64 row per key
+    # and one column per element, so result[key][i] is the value after element index i.
+    # The first 'reuse' columns are copied from 'upstream' instead of being collected again.
+    @timed('collect_data')
+    def __init__(self, r, keys=RESULT_KEYS, upstream=None, reuse=0):
+        self.keys = ['pos'] + [k for k in keys if k != 'pos']
+        self.index = np.array([i for i, _ in r], dtype=int)
+        self.data = np.empty((len(self.keys), len(r)), dtype=np.float64)
+
+        if upstream is None or upstream.keys != self.keys:
+            reuse = 0
+        reuse = min(reuse, len(r), len(upstream or []))
+        if reuse:
+            self.data[:, :reuse] = upstream.data[:, :reuse]
+
+        for n in range(reuse, len(r)):
+            state = r[n][1]
+            self.data[:, n] = [getattr(state, k) for k in self.keys]
+
+        self.data.flags.writeable = False  # columns are shared by every view
+        self._columns = {k: self.data[j] for j, k in enumerate(self.keys)}
+
+    @property
+    def pos(self):
+        return self._columns['pos']
+
+    def __getitem__(self, key):
+        return self._columns[key]
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def get(self, *keys):
+        return {k: self._columns[k] for k in keys}
+
+
+class FullRun:
+    # A full monitored run of a Model's current revision. It resumes from the checkpoint upstream
+    # of the first modified element and can work on a clone of the machine, so it is safe to
+    # execute away from the GUI thread. 'chunk_size' splits the propagation so a cancellation
+    # is noticed between chunks; 'progress', if set, is called with (last element done, last element).
+    # A 'machine' known to match the model's, e.g. built from the same config, saves the clone;
+    # with 'deferred', the thread executing the run passes one to use_machine() beforehand.
+    def __init__(self, model, clone=False, chunk_size=None, machine=None, deferred=False):
+        self.owner = model
+        self.revision = model.revision
+        self.dirty_index = model._dirty_index
+        self.previous = model._cached_run
+        self.checkpoints = model._checkpoints
+        self.bmstate = model.bmstate
+        self.edit_log, self.edits = model.edit_log()  # the machine of this revision is the log's first 'edits'
+        self.chunk_size = chunk_size
+        self.cancelled = False
+        self.progress = None
+        self.r = self.s = self.result = None
+
+        if machine is not None or clone:
+            self.use_machine(machine if machine is not None else model.clone_machine())
+        elif deferred:
+            self.model = None
+        else:
+            self.model = model
+
+    def use_machine(self, machine):
+        self.model = ModelFlame(machine=machine)
+        self.model.bmstate = self.bmstate
+
+    @timed('FullRun.execute')
+    def execute(self):
+        res = self._resume()
+        if res is None:  # cancelled
+            return None
+
+        r, s, reused = res
+        upstream = self.previous[2] if self.previous else None
+        self.result = SimulationResult(r, upstream=upstream, reuse=reused)
+        self.r, self.s = r, s
+        return self
+
+    def _resume(self):
+        # returns (r, s, number of leading entries of r taken from the previous run)
+        upstream = [i for i in self.checkpoints if i < self.dirty_index]
+        if self.previous is None or not upstream:
+            return self._propagate(1, [], None)
+
+        resume_index = max(upstream)
+        prev_r, _ = self.previous[1]
+        r = prev_r[:resume_index + 1]
+        if resume_index + 1 >= len(self.model.machine):
+            return r, r[-1][1].clone(), len(r)
+
+        checkpoint = self.checkpoints[resume_index]
+        if isinstance(checkpoint.state, BeamState):  # flame_utils wraps the initial state twice
+            checkpoint = checkpoint.state
+        return self._propagate(resume_index + 1, r, checkpoint)
+
+    def _propagate(self, start, r, bmstate):
+        profiler.count_run()
+        reused = len(r)
+        last = len(self.model.machine) - 1
+        while True:
+            end = last if self.chunk_size is None else min(start + self.chunk_size - 1, last)
+            if bmstate is None:  # from the source with the model's own initial beam state
+                chunk_r, bmstate = ModelFlame.run(self.model, to_element=end, monitor='all')
+            else:
+                chunk_r, bmstate = ModelFlame.run(self.model, bmstate=bmstate, from_element=start, to_element=end,
+                                                  monitor='all', include_initial_state=False)
+            r = r + chunk_r
+            if self.progress is not None:
+                self.progress(end, last)
+            if end >= last:
+                return r, bmstate, reused
+            if self.cancelled:
+                return None
+            start = end + 1
+
+
+class ElementIndex:
+    # name -> sorted indexes, type -> sorted indexes and index -> properties of every lattice element,
+    # kept in step with the machine by Model instead of scanning machine.conf() on each lookup
+    def __init__(self, elements):
+        self.properties = [element['properties'] for element in elements]
+        self.names = {}
+        self.types = {}
+        for i, properties in enumerate(self.properties):
+            self.names.setdefault(properties['name'], []).append(i)
+            self.types.setdefault(properties['type'], []).append(i)
+
+    def __len__(self):
+        return len(self.properties)
+
+    def insert(self, index, properties):
+        index = min(index, len(self.properties))
+        self._shift(index, 1)
+        self.properties.insert(index, properties)
+        self._add(index, properties)
+
+    def pop(self, index):
+        properties = self.properties.pop(index)
+        self._remove(index, properties)
+        self._shift(index, -1)
+
+    def replace(self, index, properties):
+        self._remove(index, self.properties[index])
+        self.properties[index] = properties
+        self._add(index, properties)
+
+    def _add(self, index, properties):
+        bisect.insort(self.names.setdefault(properties['name'], []), index)
+        bisect.insort(self.types.setdefault(properties['type'], []), index)
+
+    def _remove(self, index, properties):
+        for mapping, key in ((self.names, properties['name']), (self.types, properties['type'])):
+            mapping[key].remove(index)
+            if not mapping[key]:
+                del mapping[key]
+
+    def _shift(self, index, step):
+        # every element at or beyond 'index' moves by 'step'
+        for mapping in (self.names, self.types):
+            for indexes in mapping.values():
+                for j in range(bisect.bisect_left(indexes, index), len(indexes)):
+                    indexes[j] += step
+
 
 class Model(ModelFlame):
+    checkpoint_stride = 1  # keep the beam state after every n-th element of the last full run
+    # element properties the drawn lattice layout depends on: the type and length, and only the sign of a strength
+    layout_keys = {'type', 'L'}
+    layout_sign_keys = {'B', 'B2', 'B3', 'V', 'phi', 'scl_fac'}
+    _layout_revisions = itertools.count(1)  # shared, so no two models have the same layout revision
+    max_edit_log = 10000  # machine edits logged before the log starts over
+
     def __init__(self, lat_file=None, **kws):
+        self._revision = 0
+        self._edits = []  # (method, kwargs) of the machine edits since the machine was set, see edit_log()
+        self._layout_revision = next(self._layout_revisions)
+        self._cached_run = None  # (revision, (r, s), SimulationResult) of the last full monitored run
+        self._checkpoints = {}  # element index -> BeamState after that element
+        self._dirty_index = 0  # first element whose simulated state is out of date
+        self._element_index = None  # built on first lookup
+        self.journal = None  # classes.history.History recording undoable edits
+
         if lat_file != None or kws:
             super().__init__(lat_file=lat_file, **kws)
         else:
@@ -37,6 +238,209 @@ class Model(ModelFlame):
             
             super().__init__(machine=Machine(conf))
 
+    @property
+    def revision(self):
+        return self._revision
+
+    def bump_revision(self, index=0):
+        # 'index' is the first element affected by the change, everything upstream can be reused
+        self._revision += 1
+        self._dirty_index = min(self._dirty_index, index)
+
+    @property
+    def layout_revision(self):
+        # changes when elements are added or removed, or get a new type, length or strength sign
+        return self._layout_revision
+
+    def bump_layout_revision(self):
+        self._layout_revision = next(self._layout_revisions)
+
+    def edit_log(self):
+        # (log, length): replaying the first 'length' calls of the log on a copy of the machine it was
+        # started for gives the current machine. The log is only appended to, so a copy can be brought
+        # up to date on another thread; a new machine, or a full log, starts a new log
+        return self._edits, len(self._edits)
+
+    def _log_edit(self, method, kwargs):
+        if len(self._edits) >= self.max_edit_log:
+            self._edits = []  # copies of the machine start over from a new clone
+        self._edits.append((method, kwargs))
+
+    @property
+    def machine(self):
+        return ModelFlame.machine.fget(self)
+
+    @machine.setter
+    def machine(self, m):
+        ModelFlame.machine.fset(self, m)
+        self._edits = []
+        self._element_index = None
+        self.bump_revision()
+        self.bump_layout_revision()
+
+    @property
+    def bmstate(self):
+        return ModelFlame.bmstate.fget(self)
+
+    @bmstate.setter
+    def bmstate(self, s):
+        ModelFlame.bmstate.fset(self, s)
+        self.bump_revision()
+
+    def configure(self, econf):
+        super().configure(econf)
+        self._edits = []
+        self._element_index = None
+        self.bump_revision()
+        self.bump_layout_revision()
+
+    def reconfigure(self, index, properties):
+        idx = self._resolve_indexes(index, types=True)
+        layout_changed = any(self._changes_layout(self.get_element_index().properties[i], properties) for i in idx)
+        if self.journal is not None:
+            for i in idx:
+                old = self.get_element_index().properties[i]
+                if all(k in old for k in properties):
+                    inverse = [('reconfigure', {'index': i, 'properties': {k: old[k] for k in properties}})]
+                else:  # reconfigure cannot remove attributes, so the old element is put back whole
+                    inverse = [('pop_element', {'index': i}),
+                               ('insert_element', {'index': i, 'element': dict(self.machine.conf(i))})]
+                self.journal.record([('reconfigure', {'index': i, 'properties': dict(properties)})], inverse)
+        super().reconfigure(index, properties)
+        for i in idx:
+            self._log_edit('reconfigure', {'index': i, 'properties': dict(properties)})
+
+        if self._element_index is not None:
+            for i in idx:
+                self._element_index.replace(i, super().get_element(index=i)[0]['properties'])
+        self.bump_revision(min(idx, default=0))
+        if layout_changed:
+            self.bump_layout_revision()
+
+    def _changes_layout(self, old, properties):
+        for k, v in properties.items():
+            if k in self.layout_keys and old.get(k) != v:
+                return True
+            if k in self.layout_sign_keys and np.sign(old.get(k, 0.0)) != np.sign(v):
+                return True
+        return False
+
+    def insert_element(self, index=None, element=None, econf=None):
+        if econf is not None:
+            index, element = econf['index'], econf['properties']
+        idx = self._resolve_indexes(index)[:1]
+        super().insert_element(index=index, element=element)
+
+        if idx and element is not None:
+            self._log_edit('insert_element', {'index': idx[0], 'element': dict(element)})
+            if self._element_index is not None:
+                self._element_index.insert(idx[0], super().get_element(index=idx[0])[0]['properties'])
+            if self.journal is not None:
+                self.journal.record([('insert_element', {'index': idx[0], 'element': dict(element)})],
+                                    [('pop_element', {'index': idx[0]})])
+        self.bump_revision(min(idx, default=0))
+        self.bump_layout_revision()
+
+    def pop_element(self, index=None):
+        idx = self._resolve_indexes(index)
+        if self.journal is not None and idx:
+            properties = [dict(self.machine.conf(i)) for i in idx]
+            self.journal.record([('pop_element', {'index': i}) for i in reversed(idx)],
+                                [('insert_element', {'index': i, 'element': p}) for i, p in zip(idx, properties)])
+        super().pop_element(index=index)
+        for i in reversed(idx):
+            self._log_edit('pop_element', {'index': i})
+
+        if self._element_index is not None:
+            for i in reversed(idx):
+                self._element_index.pop(i)
+        self.bump_revision(min(idx, default=0))
+        self.bump_layout_revision()
+
+    def _resolve_indexes(self, index, types=False):
+        # sorted element indexes referred to by an index, a name (or type) or a list of them
+        if index is None:
+            return []
+        if not isinstance(index, (list, tuple, range)):
+            index = [index]
+
+        element_index = self.get_element_index()
+        idx = set()
+        for elem in index:
+            if isinstance(elem, str):
+                idx.update(element_index.names.get(elem, []))
+                if types:
+                    idx.update(element_index.types.get(elem, []))
+            else:
+                elem = int(elem)
+                idx.add(elem + len(element_index) if elem < 0 else elem)
+        return sorted(idx)
+
+    def get_element_index(self):
+        if self._element_index is None:
+            self._element_index = ElementIndex(super().get_element(index=list(range(len(self.machine)))))
+        return self._element_index
+
+    def get_all_names(self, type=None):
+        # unique names in order of first appearance, as flame_utils gives them, from the index
+        element_index = self.get_element_index()
+        if type is None:
+            return sorted(element_index.names, key=lambda name: element_index.names[name][0])
+        return list(dict.fromkeys(element_index.properties[i]['name'] for i in element_index.types.get(type, [])))
+
+    def get_all_elements(self):
+        properties = self.get_element_index().properties
+        return [{'index': i, 'properties': p} for i, p in enumerate(properties)]
+
+    def get_element_by_index(self, index):
+        return {'index': index, 'properties': self.get_element_index().properties[index]}
+
+    def get_element_by_name(self, name):
+        # first element with the name, raises KeyError if there is none
+        return self.get_element_by_index(self.get_element_index().names[name][0])
+
+    def get_indexes_by_name(self, name):
+        return list(self.get_element_index().names.get(name, []))
+
+    def get_indexes_by_type(self, type):
+        return list(self.get_element_index().types.get(type, []))
+
+    def has_element_name(self, name):
+        return name in self.get_element_index().names
+
+    @timed('Model.run')
+    def run(self, bmstate=None, from_element=None, to_element=None, monitor=None, include_initial_state=True):
+        # the full monitored run is shared by every view, so it is only simulated once per revision
+        is_full_run = (bmstate is None and from_element is None and to_element is None
+                       and monitor == 'all' and include_initial_state)
+        if not is_full_run:
+            profiler.count_run()
+            return super().run(bmstate=bmstate, from_element=from_element, to_element=to_element,
+                               monitor=monitor, include_initial_state=include_initial_state)
+
+        return self._get_full_run()[0]
+
+    def get_result(self):
+        return self._get_full_run()[1]
+
+    def _get_full_run(self):
+        if not self.has_current_result():
+            self.install_full_run(FullRun(self).execute())
+        return self._cached_run[1:]
+
+    def has_current_result(self):
+        return self._cached_run is not None and self._cached_run[0] == self._revision
+
+    def install_full_run(self, run):
+        # adopt a run executed elsewhere, unless the model has changed since it was requested
+        if run is None or run.owner is not self or run.revision != self._revision or self.has_current_result():
+            return False
+
+        self._cached_run = (run.revision, (run.r, run.s), run.result)
+        self._checkpoints = {i: state for i, state in run.r if i % self.checkpoint_stride == 0}
+        self._dirty_index = len(self.machine)
+        return True
+
     def get_value_by_element_attribute(self, attribute, latfile=None, index=None, name=None, type=None, **kws):
         element = self.get_element(latfile=latfile, index=index, name=name, type=type, **kws)
         return element['properties'][attribute]
@@ -145,4 +549,18 @@ class Model(ModelFlame):
     def get_prime_parameters(self):
         return ['xpcen', 'ypcen', 'zpcen',
                 'xprms', 'yprms', 'zprms',
-                'couple_xpy', 'couple_xyp', 'couple_xpyp']
\ No newline at end of file
+                'couple_xpy', 'couple_xyp', 'couple_xpyp']
+
+
+def serialize_model(model):
+    # plain lattice config with the current beam state baked into the source element, so a
+    # model rebuilt from it (in another process, from a snapshot) starts from the same state;
+    # Machine.conf() does not reflect reconfigure(), clone_machine() folds the edits back in
+    conf = model.clone_machine().conf()
+    source = dict(conf['elements'][0])
+    conf['elements'][0] = generate_source(model.bmstate, {'index': 0, 'properties': source})['properties']
+    return conf
+
+
+def build_model(conf):
+    return Model(machine=Machine(conf))
@@ -0,0 +1,261 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from classes.model import build_model
+from classes.profiling import profiler, timed
+
+# beam-state knobs set through BeamState.set_twiss() rather than a plain attribute
+TWISS_KNOBS = {'beam size': 'rmssize',
+               'twiss beta': 'beta',
+               'alpha': 'alpha',
+               'geom. emittance': 'emittance',
+               'norm. emittance': 'nemittance'}
+
+
+class OptimizationCancelled(Exception):
+    pass
+
+
+def apply_knobs(model, knobs, x):
+    # knobs maps an element name to the attribute to vary, or a beam-state knob name
+    # to its glb.data['element']['beam state'] entry
+    for (name, attr), val in zip(knobs.items(), x):
+        val = float(val)
+        if isinstance(attr, dict):
+            for ext, kw in TWISS_KNOBS.items():
+                if ext in name:
+                    model.bmstate.set_twiss(name[:1], **{kw: val})
+                    break
+            else:
+                setattr(model.bmstate, attr['abbreviation'], val)
+            model.bump_revision()
+        else:
+            model.reconfigure(name, {attr: val})
+
+
+def span_start(model, knobs):
+    # (index of the first knob, beam state entering it), computed once so evaluations
+    # only propagate from the knobs to the target; None when every evaluation needs a full run
+    if any(isinstance(attr, dict) for attr in knobs.values()):
+        return None  # beam-state knobs change the initial state
+    first = min(model.get_indexes_by_name(name)[0] for name in knobs)
+    if first <= 1:
+        return None
+    r, s = model.run(to_element=first - 1)
+    return first, s
+
+
+def evaluate(model, knobs, obj, x, start=None):
+    apply_knobs(model, knobs, x)
+    if start is None:
+        r, s = model.run(to_element=obj['location'])
+    else:
+        r, s = model.run(bmstate=start[1], from_element=start[0], to_element=obj['location'])
+    dif = []
+    for n, v in obj['target'].items():
+        if isinstance(v, (list, tuple)):  # [target value, weight]
+            val = (getattr(s, n) - v[0]) * v[1]
+        elif isinstance(v, (int, float)):
+            val = getattr(s, n) - v
+        else:
+            val = 0.0
+        dif.append(val)
+    dif = np.asarray(dif, dtype=float)
+    return float(np.sum(dif * dif))
+
+
+# process-local model and span start shared by every Cost evaluated in this process
+_model = None
+_start = None
+
+
+def init_model(conf, knobs):
+    # pool initializer: each worker builds its own model once and reuses it for every evaluation
+    global _model, _start
+    _model = build_model(conf)
+    _start = span_start(_model, knobs)
+
+
+class Cost:
+    def __init__(self, knobs, obj):
+        self.knobs = knobs
+        self.obj = obj
+
+    def __call__(self, x):
+        return evaluate(_model, self.knobs, self.obj, x, _start)
+
+    def batch(self, xs):
+        # xs holds one knob vector per row
+        return [evaluate(_model, self.knobs, self.obj, x, _start) for x in xs]
+
+
+class CostCache:
+    # LRU of costs keyed on the knob vector rounded to tol; each optimization process builds its own,
+    # so the lattice and objective are fixed for the cache's lifetime and need no part in the key
+    def __init__(self, size, tol=0.0):
+        self.size = size
+        self.tol = tol
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.tol > 0:
+            x = np.round(x / self.tol) + 0.0  # + 0.0 folds -0.0 into 0.0
+        return x.tobytes()
+
+    def get(self, x):
+        key = self.key(x)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, x, cost):
+        key = self.key(x)
+        self.entries[key] = cost
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+class CostTracker:
+    def __init__(self, cost, cancel=None, pool=None, workers=1, cache=None):
+        self.cost = cost
+        self.cancel = cancel
+        self.pool = pool
+        self.workers = workers
+        self.cache = cache
+        self.nfev = 0
+        self.best_cost = np.inf
+        self.best_x = None
+
+    def __call__(self, x):
+        self.check_cancelled()
+        return self.evaluate_all([x], lambda xs: [self.cost(xs[0])])[0]
+
+    def map(self, func, iterable):
+        # used as differential_evolution's workers: one population evaluated across the pool. 'func' wraps
+        # this tracker, which cannot go to the pool, so the pool gets the bare cost
+        self.check_cancelled()
+        return self.evaluate_all(list(iterable), lambda xs: self.pool.map(self.cost, xs))
+
+    def batch(self, xs):
+        # vectorized differential_evolution: xs is the (n_knobs, popsize) population and a
+        # cost vector is returned; the population is split into one chunk per worker so each
+        # worker costs a single pickle round-trip per generation. The polish step passes a 1-D x.
+        xs = np.asarray(xs, dtype=float)
+        if xs.ndim == 1:
+            return self(xs)
+        self.check_cancelled()
+        return np.asarray(self.evaluate_all(list(xs.T), self.batch_in_pool))
+
+    def batch_in_pool(self, xs):
+        if self.pool is None:
+            return self.cost.batch(xs)
+        chunks = [c for c in np.array_split(np.asarray(xs), self.workers) if len(c)]
+        return [cost for chunk in self.pool.map(self.cost.batch, chunks) for cost in chunk]
+
+    @timed('optimizer cost')
+    def evaluate_all(self, xs, evaluate):
+        # costs from the cache where possible; evaluate() runs FLAME for the rest in one go
+        costs = [None if self.cache is None else self.cache.get(x) for x in xs]
+        missing = [i for i, cost in enumerate(costs) if cost is None]
+        if missing:
+            for i, cost in zip(missing, evaluate([xs[i] for i in missing])):
+                costs[i] = cost
+                self.record(xs[i], cost)
+                if self.cache is not None:
+                    self.cache.put(xs[i], cost)
+        return costs
+
+    def record(self, x, cost):
+        self.nfev += 1
+        if cost < self.best_cost:
+            self.best_cost = cost
+            self.best_x = np.array(x, dtype=float)
+
+    def cache_stats(self):
+        return {} if self.cache is None else self.cache.stats()
+
+    def check_cancelled(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise OptimizationCancelled()
+
+
+def optimize(problem, queue, cancel):
+    # entry point of the optimizer process; messages put on the queue are
+    # ('progress', iteration, best cost, best x), then ('profile', profiler export of this optimization)
+    # and one of ('done', best x, best cost, summary, cache stats), ('cancelled', ...) or ('error', message)
+    import multiprocessing as mp
+    import os
+    from scipy.optimize import differential_evolution, minimize
+
+    profile_start = profiler.export()
+
+    def finish(msg):
+        queue.put(('profile', profiler.export(since=profile_start)))
+        queue.put(msg)
+
+    pool = None
+    try:
+        init_model(problem['conf'], problem['knobs'])
+        workers = problem.get('workers') or os.cpu_count() or 1
+        if problem['method'] != 'Nelder-Mead' and workers > 1:
+            pool = mp.get_context('spawn').Pool(workers, initializer=init_model,
+                                                initargs=(problem['conf'], problem['knobs']))
+        cache = None
+        if problem.get('cache_size'):
+            cache = CostCache(problem['cache_size'], problem.get('cache_tol', 0.0))
+        cost = CostTracker(Cost(problem['knobs'], problem['obj']), cancel, pool, workers, cache)
+        iteration = [0]
+        limits = {'maxiter': problem['maxiter']} if problem.get('maxiter') else {}  # optional iteration cap
+
+        def report(xk, *args, **kwargs):
+            iteration[0] += 1
+            if cost.best_x is not None:
+                queue.put(('progress', iteration[0], cost.best_cost, cost.best_x.tolist()))
+            cost.check_cancelled()
+
+        try:
+            if problem['method'] == 'Nelder-Mead':
+                ans = minimize(cost, x0=np.asarray(problem['x0'], dtype=float), method='Nelder-Mead', callback=report,
+                               options=limits)
+            elif problem.get('vectorized'):
+                ans = differential_evolution(cost.batch, bounds=problem['bounds'], callback=report,
+                                             vectorized=True, updating='deferred', **limits)
+            elif pool is None:
+                ans = differential_evolution(cost, bounds=problem['bounds'], callback=report, workers=1, **limits)
+            else:
+                # the population is evaluated in the pool; the final polish runs on this process's model,
+                # through the tracker like every other evaluation
+                ans = differential_evolution(cost, bounds=problem['bounds'], callback=report,
+                                             workers=cost.map, updating='deferred', **limits)
+        except OptimizationCancelled:
+            if cost.best_x is None:
+                finish(('cancelled', None, None, 'Cancelled before the first evaluation.', cost.cache_stats()))
+            else:
+                summary = 'cancelled after {} iterations, {} evaluations\nbest cost: {}\nbest x: {}'.format(
+                    iteration[0], cost.nfev, cost.best_cost, cost.best_x)
+                finish(('cancelled', cost.best_x.tolist(), cost.best_cost, summary, cost.cache_stats()))
+            return
+
+        # keep whichever is lower: the reported minimum or the best evaluation seen
+        if cost.best_x is not None and cost.best_cost < ans.fun:
+            best_x, best_cost = cost.best_x, cost.best_cost
+        else:
+            best_x, best_cost = np.atleast_1d(ans.x), float(ans.fun)
+        finish(('done', np.asarray(best_x, dtype=float).tolist(), best_cost, str(ans), cost.cache_stats()))
+    except Exception as e:
+        finish(('error', str(e)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
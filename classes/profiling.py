@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+
+class Profiler:
+    # call counts and durations of the functions wrapped with timed(), plus the FLAME runs
+    # started during each user action; updated from the GUI thread and the simulation worker.
+    # While tracing, every call is also kept as a span for a Chrome trace file (off by default)
+    def __init__(self, max_actions=100, max_events=10**6):
+        self.lock = threading.Lock()
+        self.stats = {}  # name -> [calls, total seconds, max seconds]
+        self.runs = 0
+        self.actions = deque(maxlen=max_actions)  # [label, FLAME runs, start time], most recent last
+        self.tracing = False
+        self.max_events = max_events
+        self.events = []  # (name, perf_counter start, seconds or None for an instant, thread id)
+        self.dropped = 0  # events past max_events
+        self.thread_names = {}
+
+    def add(self, name, seconds):
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                self.stats[name] = [1, seconds, seconds]
+            else:
+                stat[0] += 1
+                stat[1] += seconds
+                stat[2] = max(stat[2], seconds)
+
+    def count_run(self, n=1):
+        with self.lock:
+            self.runs += n
+            if self.actions:
+                self.actions[-1][1] += n
+
+    def begin_action(self, label):
+        # runs counted from here on belong to this action, until the next one begins
+        with self.lock:
+            self.actions.append([label, 0, time.time()])
+        if self.tracing:
+            self.trace(label, time.perf_counter(), None)
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+            self.actions.clear()
+            self.runs = 0
+
+    def export(self, since=None):
+        # plain data for another process to merge(); with 'since', an earlier export,
+        # only what was added after it (max durations cannot be split and are kept whole)
+        with self.lock:
+            stats = {name: list(stat) for name, stat in self.stats.items()}
+            runs = self.runs
+        if since is not None:
+            for name, (calls, total, longest) in since['stats'].items():
+                stat = stats.get(name)
+                if stat is None:  # reset in between
+                    continue
+                stat[0] -= calls
+                stat[1] -= total
+                if stat[0] == 0:
+                    del stats[name]
+            runs -= since['runs']
+        return {'stats': stats, 'runs': runs}
+
+    def merge(self, exported):
+        with self.lock:
+            for name, (calls, total, longest) in exported['stats'].items():
+                stat = self.stats.setdefault(name, [0, 0.0, 0.0])
+                stat[0] += calls
+                stat[1] += total
+                stat[2] = max(stat[2], longest)
+        self.count_run(exported['runs'])
+
+    def table(self):
+        # (name, calls, total, mean, max) sorted by total time, longest first
+        with self.lock:
+            rows = [(name, calls, total, total / calls, longest)
+                    for name, (calls, total, longest) in self.stats.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def recent_actions(self):
+        with self.lock:
+            return [tuple(action) for action in reversed(self.actions)]
+
+    def start_tracing(self):
+        with self.lock:
+            self.events = []
+            self.dropped = 0
+        self.tracing = True
+
+    def stop_tracing(self):
+        self.tracing = False
+
+    def trace(self, name, start, seconds):
+        tid = threading.get_ident()
+        with self.lock:
+            if len(self.events) >= self.max_events:
+                self.dropped += 1
+                return
+            self.events.append((name, start, seconds, tid))
+            if tid not in self.thread_names:
+                self.thread_names[tid] = threading.current_thread().name
+
+    def trace_events(self):
+        # Chrome Trace Event format: complete events for spans, global instant events for user actions
+        pid = os.getpid()
+        with self.lock:
+            events, names = list(self.events), dict(self.thread_names)
+        trace = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': 'FLAME-GUI'}}]
+        trace += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in names.items()]
+        for name, start, seconds, tid in events:
+            event = {'name': name, 'cat': 'flame-gui', 'ts': start * 1e6, 'pid': pid, 'tid': tid}
+            if seconds is None:
+                event.update({'ph': 'i', 's': 'g', 'cat': 'action'})
+            else:
+                event.update({'ph': 'X', 'dur': seconds * 1e6})
+            trace.append(event)
+        return trace
+
+    def write_trace(self, path):
+        # opens in chrome://tracing or ui.perfetto.dev
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms',
+                       'otherData': {'dropped_events': self.dropped}}, f)
+
+
+profiler = Profiler()
+
+
+def timed(name):
+    # decorator recording each call of the function under 'name'
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                profiler.add(name, seconds)
+                if profiler.tracing:
+                    profiler.trace(name, start, seconds)
+        return wrapper
+    return decorate
@@ -0,0 +1,138 @@
+import pickle
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ArrayRef:
+    # placeholder for an entry of the packed array table
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getstate__(self):
+        return self.index
+
+    def __setstate__(self, index):
+        self.index = index
+
+
+def same_value(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return (isinstance(a, np.ndarray) and isinstance(b, np.ndarray)
+                and a.dtype == b.dtype and np.array_equal(a, b))
+    return type(a) is type(b) and a == b
+
+
+def pack_conf(conf):
+    # compact bytes for a lattice config: element keys inherited from the top level are dropped,
+    # identical element dicts and arrays are stored once and the whole payload is zlib-compressed
+    arrays = []
+    array_ids = {}
+
+    def encode(v):
+        if not isinstance(v, np.ndarray):
+            return v
+        key = (v.dtype.str, v.shape, v.tobytes())
+        if key not in array_ids:
+            array_ids[key] = len(arrays)
+            arrays.append(key)
+        return ArrayRef(array_ids[key])
+
+    top = OrderedDict((k, v) for k, v in conf.items() if k != 'elements')
+    keys = list(conf)
+    inherited = set(keys[:keys.index('elements')])  # FLAME only lets elements inherit keys preceding 'elements'
+    table = []
+    table_ids = {}
+    elements = []
+    for element in conf['elements']:
+        own = {k: encode(v) for k, v in element.items() if not (k in inherited and same_value(v, top[k]))}
+        key = pickle.dumps(sorted((k, v.index if isinstance(v, ArrayRef) else v, isinstance(v, ArrayRef))
+                                  for k, v in own.items()))
+        if key not in table_ids:
+            table_ids[key] = len(table)
+            table.append(own)
+        elements.append(table_ids[key])
+
+    payload = {'keys': keys,
+               'top': OrderedDict((k, encode(v)) for k, v in top.items()),
+               'table': table,
+               'elements': np.asarray(elements, dtype=np.int32),
+               'arrays': arrays}
+    return zlib.compress(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def unpack_conf(blob):
+    payload = pickle.loads(zlib.decompress(blob))
+    arrays = [np.frombuffer(data, dtype=np.dtype(dtype)).reshape(shape).copy()
+              for dtype, shape, data in payload['arrays']]
+
+    def decode(v):
+        return arrays[v.index] if isinstance(v, ArrayRef) else v
+
+    table = [OrderedDict((k, decode(v)) for k, v in element.items()) for element in payload['table']]
+    conf = OrderedDict()
+    for k in payload['keys']:
+        if k == 'elements':
+            conf[k] = [OrderedDict(table[i]) for i in payload['elements']]
+        else:
+            conf[k] = decode(payload['top'][k])
+    return conf
+
+
+class SnapshotStore:
+    # named model snapshots kept packed within a byte budget, least recently used evicted first;
+    # a few unpacked configs are kept so switching back and forth skips decompression
+    def __init__(self, max_bytes=32 * 2**20, unpacked=2):
+        self.max_bytes = max_bytes
+        self.unpacked = unpacked
+        self._packed = OrderedDict()  # name -> bytes, least recently used first
+        self._confs = OrderedDict()  # name -> lattice config
+
+    def names(self):
+        return list(self._packed)
+
+    def nbytes(self):
+        return sum(len(blob) for blob in self._packed.values())
+
+    def save(self, name, model):
+        # returns the names evicted to stay within the budget
+        from classes.model import serialize_model
+
+        self._confs.pop(name, None)
+        self._packed[name] = pack_conf(serialize_model(model))
+        self._packed.move_to_end(name)
+        return self.enforce_limit()
+
+    def load(self, name):
+        # a new Model every time, so editing it never alters the snapshot
+        from flame import Machine
+        from classes.model import Model
+
+        self._packed.move_to_end(name)
+        conf = self._confs.get(name)
+        if conf is None:
+            conf = unpack_conf(self._packed[name])
+            self._confs[name] = conf
+            while len(self._confs) > self.unpacked:
+                self._confs.popitem(last=False)
+        self._confs.move_to_end(name)
+        return Model(machine=Machine(conf))
+
+    def remove(self, name):
+        self._packed.pop(name, None)
+        self._confs.pop(name, None)
+
+    def clear(self):
+        self._packed.clear()
+        self._confs.clear()
+
+    def enforce_limit(self):
+        evicted = []
+        while len(self._packed) > 1 and self.nbytes() > self.max_bytes:
+            name = next(iter(self._packed))
+            self.remove(name)
+            evicted.append(name)
+        return evicted
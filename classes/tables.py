@@ -26,15 +26,18 @@ class NelderEvoTables(QTabWidget):
         nelder_tab = QWidget()
         evo_tab = QWidget()
         nelder_tab.setLayout(QHBoxLayout())
-        evo_tab.setLayout(QHBoxLayout())
+        evo_tab.setLayout(QVBoxLayout())
 
         self.nelder = Table(0, 3)
         self.evo = Table(0, 4)
+        self.evo_vectorized = QCheckBox('Evaluate each generation as one batch')
         self.nelder.setHorizontalHeaderLabels(['Name', 'Attribute', 'x0'])
         self.evo.setHorizontalHeaderLabels(['Name', 'Attribute', 'x0-Low', 'x0-High'])
+        self.evo_vectorized.setChecked(True)
 
         nelder_tab.layout().addWidget(self.nelder)
         evo_tab.layout().addWidget(self.evo)
+        evo_tab.layout().addWidget(self.evo_vectorized)
         self.addTab(nelder_tab, 'Nelder-Mead')
         self.addTab(evo_tab, 'Differential Evolution')
 
@@ -54,7 +57,7 @@ class NelderEvoTables(QTabWidget):
         for component in bmstate:
             knobs.append(component)
         for i in element_indexes:
-            element = glb.model.get_element(index=i)[0] # ['properties']['name']
+            element = glb.model.get_element_by_index(i)
             knobs.append(element)
 
         for knob in knobs:
@@ -220,7 +223,7 @@ class MatrixTable(Table):
                 self.setCellWidget(i, j, line_edit)
 
     def fill(self, element_name):
-        matrix = glb.model.get_element(name=element_name)[0]['properties']['matrix']
+        matrix = glb.model.get_element_by_name(element_name)['properties']['matrix']
         
         row, column = 0, 0
         for i in range(len(matrix)):
@@ -1,8 +1,10 @@
 import globals as glb
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QCursor
 from PyQt5.QtWidgets import *
 
+from classes.profiling import timed
+
 
 class Tree(QTreeWidget):
     def __init__(self):
@@ -62,6 +64,8 @@ class Tree(QTreeWidget):
 
 
 class ModelElementView(Tree):
+    fill_chunk_size = 2000  # top-level items added per event loop pass when a new lattice is shown
+
     def __init__(self):
         from classes.windows import ModelElementConfigWindow
         from classes.utility import ElementTreeDelegate
@@ -69,6 +73,7 @@ class ModelElementView(Tree):
         super().__init__()
         self._delegate = ElementTreeDelegate()  # prevents python garbage collection
         self.config_window = ModelElementConfigWindow()
+        self._fill_generation = 0  # bumped on refresh to stop a chunked fill in progress
         
         headers = ['Index', 'Name', 'Type', 'Attribute', 'Value', 'Unit']
         self.setHeaderLabels(headers)
@@ -80,71 +85,87 @@ class ModelElementView(Tree):
         
         self.itemDoubleClicked.connect(self.handleEdits)
 
+    @timed('ModelElementView.refresh')
     def refresh(self, new_file=False):
-        from classes.utility import EditMatrixButton
-        
         if not new_file:
             expanded_elements = self.getExpandedElements()
             
         self.clear()
+        self._fill_generation += 1
 
-        elements = glb.model.get_element(name=glb.model.get_all_names())[1:]
-        items_with_matrix = []
-        
-        for element in elements:
-            item = QTreeWidgetItem()
-            item.setText(0, str(element['index']))
-            if 'tmatrix' == element['properties']['type'] and item not in items_with_matrix:
-                items_with_matrix.append(item)
-            for key, val in element['properties'].items():
-                if key == 'name':
-                    item.setText(1, val)
-                elif key == 'type':
-                    if val == 'tmatrix':
-                        items_with_matrix.append(item)
-                    item.setText(2, str(val))
-                else:
-                    if item.text(3) == '' and 'L' not in element['properties'].keys():
-                        try:
-                            f_string = "{:." + str(glb.num_sigfigs - 1) + "e}"
-                            val = f_string.format(val)
-                        except:
-                            pass
-                        item.setText(3, key)
-                        if item not in items_with_matrix:
-                            item.setText(4, str(val))
-                    elif item.text(3) == '' and key == 'L':
-                        f_string = "{:." + str(glb.num_sigfigs - 1) + "e}"
-                        val = f_string.format(val)
-                        item.setText(3, key)
-                        if item not in items_with_matrix:
-                            item.setText(4, str(val))
-                    else:  # children are just attribute-value-unit tuples
+        elements = glb.model.get_all_elements()[1:]
+        if new_file:  # a new lattice may be large, so it is added a chunk at a time between events
+            self.fillChunk(elements, 0, self._fill_generation)
+            return
+
+        self.addTopLevelItems([self.createElementItem(element) for element in elements])
+        self.addMatrixButtons(elements)
+            
+        for element in expanded_elements:
+            try:
+                item = self.findItems(element, Qt.MatchExactly, 1)[0]
+                item.setExpanded(True)
+            except:
+                print(item.text(1) + " could not be found...")
+
+    @timed('ModelElementView.fillChunk')
+    def fillChunk(self, elements, start, generation):
+        if generation != self._fill_generation:
+            return
+        chunk = elements[start:start + self.fill_chunk_size]
+        self.addTopLevelItems([self.createElementItem(element) for element in chunk])
+        self.addMatrixButtons(chunk)
+        if start + self.fill_chunk_size < len(elements):
+            QTimer.singleShot(0, lambda: self.fillChunk(elements, start + self.fill_chunk_size, generation))
+
+    def createElementItem(self, element):
+        item = QTreeWidgetItem()
+        item.setText(0, str(element['index']))
+        has_matrix = element['properties']['type'] == 'tmatrix'
+        for key, val in element['properties'].items():
+            if key == 'name':
+                item.setText(1, val)
+            elif key == 'type':
+                item.setText(2, str(val))
+            else:
+                if item.text(3) == '' and 'L' not in element['properties'].keys():
+                    try:
                         f_string = "{:." + str(glb.num_sigfigs - 1) + "e}"
                         val = f_string.format(val)
-                        child = QTreeWidgetItem()
-                        item.addChild(child)
-                        child.setText(3, key)
-                        if child not in items_with_matrix:
-                            child.setText(3, str(val))
-                        child.setText(5, glb.model.get_attribute_unit(key))
-            item.setText(5, glb.model.get_attribute_unit(item.text(3)))
-            self.addTopLevelItem(item)
-            
-            for item in items_with_matrix:
+                    except:
+                        pass
+                    item.setText(3, key)
+                    if not has_matrix:
+                        item.setText(4, str(val))
+                elif item.text(3) == '' and key == 'L':
+                    f_string = "{:." + str(glb.num_sigfigs - 1) + "e}"
+                    val = f_string.format(val)
+                    item.setText(3, key)
+                    if not has_matrix:
+                        item.setText(4, str(val))
+                else:  # children are just attribute-value-unit tuples
+                    f_string = "{:." + str(glb.num_sigfigs - 1) + "e}"
+                    val = f_string.format(val)
+                    child = QTreeWidgetItem()
+                    item.addChild(child)
+                    child.setText(3, key)
+                    child.setText(4, str(val))
+                    child.setText(5, glb.model.get_attribute_unit(key))
+        item.setText(5, glb.model.get_attribute_unit(item.text(3)))
+        return item
+
+    def addMatrixButtons(self, elements):
+        # item widgets can only be set once the items are in the tree
+        from classes.utility import EditMatrixButton
+
+        for element in elements:
+            if element['properties']['type'] == 'tmatrix':
+                item = self.topLevelItem(element['index'] - 1)
                 self.setItemWidget(item, 4, EditMatrixButton(element_name=item.text(1), parent=self))
-            
-        if not new_file:
-            for element in expanded_elements:
-                try:
-                    item = self.findItems(element, Qt.MatchExactly, 1)[0]
-                    item.setExpanded(True)
-                except:
-                    print(item.text(1) + " could not be found...")
 
     def handlePostEdit(self, item):
-        menu_bar = self.main_window.menuBar()
-        menu_bar.copyModelToHistory()
+        menu_bar = glb.main_window.menuBar()
+        menu_bar.copyModelToHistory('edit value')
         
         attribute = item.text(3)
         unit = item.text(5)
@@ -238,6 +259,7 @@ class ModelElementView(Tree):
                 warning.close()
                 return
 
+        glb.main_window.menuBar().copyModelToHistory('remove element')
         glb.model.pop_element(int(item.text(0)))
         glb.main_window.refresh()
 
@@ -1,31 +1,36 @@
-import flame
+import os
+
 import globals as glb
 import numpy as np
-from flame_utils import ModelFlame
 from matplotlib.backends.backend_qtagg import NavigationToolbar2QT
 from matplotlib.lines import Line2D
+from matplotlib.path import Path
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QDoubleValidator, QKeySequence
 from PyQt5.QtWidgets import *
 
-from classes.model import Model
+from classes.history import History
+from classes.profiling import profiler
+from classes.snapshots import SnapshotStore
 
 
 class MenuBar(QMenuBar):
-    def __init__(self, parent=None):
-        from classes.windows import (BeamStateWindow, OptimizationWindow,
-                                     PhaseSpaceWindow, PreferenceWindow)
+    # tool windows by attribute, built on first use
+    window_classes = {'bmstate_window': 'BeamStateWindow',
+                      'opt_window': 'OptimizationWindow',
+                      'perf_window': 'PerformanceWindow',
+                      'phase_window': 'PhaseSpaceWindow',
+                      'pref_window': 'PreferenceWindow'}
 
+    def __init__(self, parent=None):
         super().__init__(parent=parent)
         self.filename = ''
+        self.loader = None  # classes.workers.LatticeLoader of the file being opened
 
         # objects
-        self.bmstate_window = BeamStateWindow()
-        self.opt_window = OptimizationWindow()
-        self.phase_window = PhaseSpaceWindow()
-        self.pref_window = PreferenceWindow()
-        self.model_history = []
-        self.undo_history = []
+        self._windows = {}
+        self.history = History(max_bytes=glb.history_max_mb * 2**20)
+        self.snapshots = SnapshotStore(max_bytes=glb.snapshot_max_mb * 2**20)
         
         # menus
         file_menu = self.addMenu('File')
@@ -60,6 +65,8 @@ class MenuBar(QMenuBar):
         # 'edit' menu
         self.undo_action = QAction('&Undo', self.parent())
         self.redo_action = QAction('&Redo', self.parent())
+        save_snapshot_action = QAction('Save &Snapshot...', self.parent())
+        self.snapshot_menu = QMenu('S&witch to Snapshot', self.parent())
         bmstate_action = QAction('&Beam State', self.parent())
         opt_action = QAction('&Optimization', self.parent())
         
@@ -68,30 +75,77 @@ class MenuBar(QMenuBar):
         
         self.undo_action.triggered.connect(self.undoModels)
         self.redo_action.triggered.connect(self.redoModels)
-        bmstate_action.triggered.connect(self.bmstate_window.open)
-        opt_action.triggered.connect(self.opt_window.open)
+        save_snapshot_action.triggered.connect(self.saveSnapshot)
+        self.snapshot_menu.aboutToShow.connect(self.fillSnapshotMenu)
+        bmstate_action.triggered.connect(lambda: self.bmstate_window.open())
+        opt_action.triggered.connect(lambda: self.opt_window.open())
         
         edit_menu.addAction(self.undo_action)
         edit_menu.addAction(self.redo_action)
+        edit_menu.addSeparator()
+        edit_menu.addAction(save_snapshot_action)
+        edit_menu.addMenu(self.snapshot_menu)
+        edit_menu.addSeparator()
         edit_menu.addAction(bmstate_action)
         edit_menu.addAction(opt_action)
 
         # 'view' menu
         phase_action = QAction('&Phase Space', self.parent())
+        perf_action = QAction('P&erformance', self.parent())
         pref_action = QAction('&Preferences', self.parent())
+        stacked_action = QAction('&Stacked Panels', self.parent())
+        stacked_action.setCheckable(True)
         
-        phase_action.triggered.connect(self.phase_window.open)
-        pref_action.triggered.connect(self.pref_window.open)
+        phase_action.triggered.connect(lambda: self.phase_window.open())
+        perf_action.triggered.connect(lambda: self.perf_window.open())
+        pref_action.triggered.connect(lambda: self.pref_window.open())
+        stacked_action.toggled.connect(lambda checked: self.parent().canvas.setStacked(checked))
         
         view_menu.addAction(phase_action)
+        view_menu.addAction(perf_action)
         view_menu.addAction(pref_action)
+        view_menu.addSeparator()
+        view_menu.addAction(stacked_action)
 
         # finalizing
+        glb.app.aboutToQuit.connect(self.stopLoading)
         self.handleUndoRedoEnabling()
+
+    def getWindow(self, name):
+        if name not in self._windows:
+            import classes.windows
+            self._windows[name] = getattr(classes.windows, self.window_classes[name])()
+        return self._windows[name]
+
+    def builtWindow(self, name):
+        # None until the window has been used, so refreshes can skip it
+        return self._windows.get(name)
+
+    @property
+    def bmstate_window(self):
+        return self.getWindow('bmstate_window')
+
+    @property
+    def opt_window(self):
+        return self.getWindow('opt_window')
+
+    @property
+    def perf_window(self):
+        return self.getWindow('perf_window')
+
+    @property
+    def phase_window(self):
+        return self.getWindow('phase_window')
+
+    @property
+    def pref_window(self):
+        return self.getWindow('pref_window')
         
     def newFile(self):
         from classes.model import Model
 
+        self.stopLoading()
+        profiler.begin_action('new lattice')
         glb.model = Model()
 
         self.filename = ''
@@ -114,18 +168,61 @@ class MenuBar(QMenuBar):
                         warning.close()
                         continue
 
-                self.parent().setWindowTitle("FLAME: " + filename)
+                self.loadFile(filename)
+            break
 
-                glb.model = Model(filename)
-                if 'Eng_Data_Dir' not in glb.model.machine.conf().keys():
-                    n_conf = glb.model.machine.conf()
-                    n_conf['Eng_Data_Dir'] = flame.__file__.replace('__init__.py', 'test/data')
-                    glb.model = Model(machine=flame.Machine(n_conf))
+    def loadFile(self, filename):
+        from classes.workers import LatticeLoader
+
+        self.stopLoading()
+        profiler.begin_action('open ' + os.path.basename(filename))
+        self.loader = LatticeLoader(filename, self)
+        self.loader.progress.connect(glb.main_window.showProgress)
+        self.loader.modelReady.connect(self.handleLoadedModel)
+        self.loader.resultReady.connect(self.handleLoadedResult)
+        self.loader.failed.connect(self.handleLoadFailed)
+        self.loader.start()
+
+    def stopLoading(self):
+        if self.loader is not None:
+            self.loader.cancel()
+            self.loader.wait()
+            self.loader = None
+            glb.main_window.hideProgress()
+
+    def handleLoadedModel(self, model):
+        if self.sender() is not self.loader:  # superseded by a later open
+            return
+        glb.model = model
+        self.filename = self.loader.filename
+        glb.main_window.refresh(new_file=True, simulate=False)  # the loader runs the first simulation
+        self.clearHistory()
 
-                self.filename = filename
-                glb.main_window.refresh(new_file=True)
-                self.clearHistory()
-            break
+    def handleLoadedResult(self, run):
+        if self.sender() is not self.loader:
+            return
+        self.loader = None
+        glb.main_window.hideProgress()
+        glb.main_window.sim_worker.adoptMachine(run)
+        glb.main_window.handleSimulationResult(run)
+
+    def handleLoadFailed(self, message):
+        if self.sender() is not self.loader:
+            return
+        loader, self.loader = self.loader, None
+        glb.main_window.hideProgress()
+        if loader.model is not None:  # the lattice opened, only the first simulation failed
+            print('Simulation failed: ' + message)
+            glb.main_window.refresh()
+            return
+
+        warning = QMessageBox()
+        warning.setIcon(QMessageBox.Critical)
+        warning.setText("Could not open " + loader.filename)
+        warning.setInformativeText(message)
+        warning.setWindowTitle("ERROR")
+        warning.setStandardButtons(QMessageBox.Ok)
+        warning.exec()
         
     def saveFile(self):
         glb.model.generate_latfile(latfile=self.filename)
@@ -139,40 +236,70 @@ class MenuBar(QMenuBar):
             self.parent().handleFileName(filename=self.filename)
 
             
-    def copyModelToHistory(self):
-        from classes.model import Model
-
-        self.model_history.append(Model(machine=glb.model.clone_machine()))
-        self.undo_history.clear()
+    def copyModelToHistory(self, action='edit'):
+        # starts a new undo step; the model journals the edits that follow
+        profiler.begin_action(action)
+        self.history.max_bytes = glb.history_max_mb * 2**20
+        self.history.begin(glb.model)
         self.handleUndoRedoEnabling()
 
     def undoModels(self):
-        self.undo_history.append(glb.model)
-        glb.model = self.model_history.pop(-1)
+        profiler.begin_action('undo')
+        self.history.undo()
         self.parent().refresh()
         self.handleUndoRedoEnabling()
 
     def redoModels(self):
-        self.model_history.append(glb.model)
-        glb.model = self.undo_history.pop(-1)
+        profiler.begin_action('redo')
+        self.history.redo()
         self.parent().refresh()
         self.handleUndoRedoEnabling()
         
     def clearHistory(self):
-        self.undo_history.clear()
-        self.model_history.clear()
+        self.history.attach(glb.model)
         self.handleUndoRedoEnabling()
 
     def handleUndoRedoEnabling(self):
-        if self.model_history:
+        if self.history.can_undo():
             self.undo_action.setEnabled(True)
         else:
             self.undo_action.setEnabled(False)
 
-        if self.undo_history:
+        if self.history.can_redo():
             self.redo_action.setEnabled(True)
         else:
             self.redo_action.setEnabled(False)
+
+    def saveSnapshot(self):
+        name, ok = QInputDialog.getText(self.parent(), 'Save Snapshot', 'Snapshot name:')
+        if not ok or not name:
+            return
+
+        self.snapshots.max_bytes = glb.snapshot_max_mb * 2**20
+        evicted = self.snapshots.save(name, glb.model)
+        if evicted:
+            popup = QMessageBox()
+            popup.setIcon(QMessageBox.Information)
+            popup.setText("Snapshot memory limit reached, removed: " + ', '.join(evicted))
+            popup.setWindowTitle("SNAPSHOTS")
+            popup.setStandardButtons(QMessageBox.Ok)
+            if popup.exec() == QMessageBox.Ok:
+                popup.close()
+
+    def fillSnapshotMenu(self):
+        self.snapshot_menu.clear()
+        for name in reversed(self.snapshots.names()):  # most recently used first
+            action = self.snapshot_menu.addAction(name)
+            action.triggered.connect(lambda checked, name=name: self.loadSnapshot(name))
+        if self.snapshot_menu.isEmpty():
+            self.snapshot_menu.addAction('(none)').setEnabled(False)
+
+    def loadSnapshot(self, name):
+        self.stopLoading()
+        profiler.begin_action('snapshot ' + name)
+        glb.model = self.snapshots.load(name)
+        glb.main_window.refresh(new_file=True)
+        self.clearHistory()
         
         
 class NavigationToolbar(NavigationToolbar2QT):
@@ -368,7 +495,7 @@ class ModelElementFilters(QWidget):
             rows_to_remove = []
             for i in range(self.to_filter.rowCount()):
                 name = self.to_filter.item(i, 2).text()  # only works for select element table for optimization
-                element_type = glb.model.get_element(name=name)[0]['properties']['type']
+                element_type = glb.model.get_element_by_name(name)['properties']['type']
                 if filter_text == 'magnetic':
                     if element_type == 'drift':
                         print(name, element_type)
@@ -420,11 +547,59 @@ class ModelElementFilters(QWidget):
                     if filter_text not in item.text(1):
                         item.setHidden(True)
     
+def decimate(x, y, x0, x1, buckets):
+    # indexes of the points of a line with non-decreasing x to draw over [x0, x1]: the first, last,
+    # lowest and highest point of each of 'buckets' equal slices of the range, so at one bucket per
+    # pixel column the drawn line matches the full one and keeps its exact extrema, plus one point
+    # beyond each end of the range and any NaN, which breaks the line
+    start = max(np.searchsorted(x, x0, 'left') - 1, 0)
+    stop = min(np.searchsorted(x, x1, 'right') + 1, len(x))
+    if stop - start <= 4 * buckets or not x1 > x0:
+        return np.arange(start, stop)
+    xs, ys = x[start:stop], y[start:stop]
+    bucket = np.clip(np.floor((xs - x0) * (buckets / (x1 - x0))).astype(int), -1, buckets)  # -1, buckets: the ends
+    first = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    last = np.r_[first[1:] - 1, len(xs) - 1]
+    owner = np.repeat(np.arange(len(first)), np.diff(np.r_[first, len(xs)]))
+    keep = np.zeros(len(xs), dtype=bool)
+    keep[first] = keep[last] = True
+    keep |= np.isnan(ys)
+    for extreme in (np.fmin, np.fmax):  # ignoring NaN, which would hide the extrema of its bucket
+        hits = np.flatnonzero(ys == extreme.reduceat(ys, first)[owner])
+        keep[hits[np.diff(owner[hits], prepend=-1) != 0]] = True  # first hit of each bucket
+    return start + np.flatnonzero(keep)
+
+
 class Line(Line2D):
+    # keeps the full data but draws it decimated to the pixel width of the current view, recomputed at
+    # draw time once the view (zoom/pan), the axes size or the data changed; data limits and the
+    # full_x/full_y arrays always cover every point
     def __init__(self, xdata, ydata, param):
         super().__init__(xdata, ydata)
         self.param = param
 
+    def set_data(self, *args):
+        x, y = args if len(args) == 2 else args[0]
+        self.full_x = np.asarray(x, dtype=float)
+        self.full_y = np.asarray(y, dtype=float)
+        self.full_path = Path(np.column_stack([self.full_x, self.full_y]))
+        self.decimation_key = None
+        self.decimate = len(self.full_x) > 1 and bool(np.all(np.diff(self.full_x) >= 0))
+        super().set_data(self.full_x, self.full_y)
+
+    def get_path(self):
+        return self.full_path
+
+    def draw(self, renderer):
+        if self.decimate and self.axes is not None:
+            x0, x1 = self.axes.get_xbound()
+            pixels = max(int(self.axes.bbox.width), 1)
+            if self.decimation_key != (x0, x1, pixels):
+                index = decimate(self.full_x, self.full_y, x0, x1, pixels)
+                Line2D.set_data(self, self.full_x[index], self.full_y[index])
+                self.decimation_key = (x0, x1, pixels)
+        super().draw(renderer)
+
 
 class ElementIndexTableItemWrapper(QTableWidgetItem):
     def __init__(self, element_name, element_index):
@@ -1,13 +1,15 @@
-from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+import multiprocessing as mp
+import time
 
 import globals as glb
 import matplotlib as mpl
 import numpy as np
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QIcon
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtGui import QDoubleValidator, QIcon
 from PyQt5.QtWidgets import *
-from scipy.optimize import differential_evolution, minimize
+
+from classes.profiling import profiler, timed
 
 
 class MainWindow(QMainWindow):
@@ -16,8 +18,7 @@ class MainWindow(QMainWindow):
         from classes.trees import ModelElementView, ParameterSelect
         from classes.utility import (MenuBar, ModelElementFilters,
                                      NavigationToolbar)
-        
-        self.active_param_cnt = 0
+        from classes.workers import SimulationWorker
         
         super().__init__()
         self.setWindowTitle('FLAME-GUI')
@@ -55,18 +56,59 @@ class MainWindow(QMainWindow):
         splitter.addWidget(ws_left)
         splitter.addWidget(ws_right)
         
+        # simulation runs off the GUI thread
+        self.sim_worker = SimulationWorker(self)
+        self.sim_worker.resultReady.connect(self.handleSimulationResult)
+        glb.app.aboutToQuit.connect(self.sim_worker.stop)
+        self.sim_worker.start()
+
+        # progress of a lattice being opened
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(200)
+        self.progress_bar.hide()
+        self.statusBar().addPermanentWidget(self.progress_bar)
+
         # finalizing
         self.centralWidget().layout().addWidget(splitter)
 
-    def refresh(self, new_file=False):
+    @timed('MainWindow.refresh')
+    def refresh(self, new_file=False, simulate=True):
         if new_file:
             self.handleFileName(filename=self.menuBar().filename)
 
         self.element_view.refresh(new_file=new_file)
+        opt_window = self.menuBar().builtWindow('opt_window')
+        if opt_window is not None:
+            opt_window.refresh(new_file=new_file)
+
+        if glb.model.has_current_result():
+            self.refreshSimulationViews()
+        elif simulate:
+            self.sim_worker.request(glb.model)
+
+    def showProgress(self, text, done, total):
+        # a total of 0 shows a busy indicator
+        self.statusBar().showMessage(text)
+        self.progress_bar.setRange(0, total)
+        self.progress_bar.setValue(done)
+        self.progress_bar.show()
+
+    def hideProgress(self):
+        self.statusBar().clearMessage()
+        self.progress_bar.hide()
+
+    def handleSimulationResult(self, run):
+        glb.model.install_full_run(run)
+        if run.owner is glb.model and run.revision == glb.model.revision:  # still current
+            self.refreshSimulationViews()
+
+    @timed('MainWindow.refreshSimulationViews')
+    def refreshSimulationViews(self):
         self.canvas.refresh()
-        self.menuBar().bmstate_window.refresh()
-        self.menuBar().phase_window.refresh()
-        self.menuBar().opt_window.refresh(new_file=new_file)
+        for name in ('bmstate_window', 'phase_window'):
+            window = self.menuBar().builtWindow(name)
+            if window is not None:
+                window.refresh()
         
     def handleFileName(self, filename=''):
         if filename:
@@ -76,25 +118,10 @@ class MainWindow(QMainWindow):
         
     def paramSelectToCanvas(self, item, col):
         param = self.param_select.convertItemIntoParam(item)
-        if self.active_param_cnt <= 4 and item.checkState(col) == Qt.Unchecked:
+        if item.checkState(col) == Qt.Unchecked:
             self.canvas.removeParameter(param)
-            self.active_param_cnt -= 1
-        elif self.active_param_cnt < 4:
-            self.canvas.plotParameter(param)
-            self.active_param_cnt += 1
         else:
-            self.param_select.blockSignals(True)
-            item.setCheckState(0, Qt.Unchecked)
-            self.param_select.blockSignals(False)
-
-            warning = QMessageBox()
-            warning.setIcon(QMessageBox.Critical)
-            warning.setText("You can only select four parameters at a time!")
-            warning.setWindowTitle("ERROR")
-            warning.setStandardButtons(QMessageBox.Ok)
-
-            if warning.exec() == QMessageBox.Ok:
-                warning.close()
+            self.canvas.plotParameter(param)
         
         
 class BeamStateWindow(QWidget):
@@ -172,6 +199,7 @@ class BeamStateWindow(QWidget):
         self.activateWindow()
         self.show()
         
+    @timed('BeamStateWindow.refresh')
     def refresh(self):
         # universal section
         qa_val = glb.model.bmstate.ref_IonZ
@@ -195,7 +223,7 @@ class BeamStateWindow(QWidget):
         self.alpha_line.convertToSciNotation()
         
     def apply(self):
-        glb.main_window.menuBar().copyModelToHistory()
+        glb.main_window.menuBar().copyModelToHistory('beam state')
 
         var = self.var_box.currentText()
         qa_val = self.qa_line.text()
@@ -263,6 +291,8 @@ class BeamStateWindow(QWidget):
                 glb.model.bmstate.set_twiss(
                     var, beta=kwrd1_val, alpha=alpha_val, nemittance=kwrd2_val)
 
+        glb.model.bump_revision()  # beam state was modified in place
+
         
     def updateVariableDependant(self):
         var = self.var_box.currentText()
@@ -345,16 +375,20 @@ class PhaseSpaceWindow(QWidget):
         self.layout().addWidget(self.canvas, 3)
         self.layout().addWidget(self.table, 2)
 
+        if glb.model.has_current_result():  # built on first use, after the model was loaded
+            self.refresh()
+
     def open(self):
         self.setWindowState(self.windowState() & ~Qt.WindowMinimized | Qt.WindowActive) # restoring to maximized/normal state
         self.activateWindow()
         self.show()
         
+    @timed('PhaseSpaceWindow.refresh')
     def refresh(self, new_file=False):
         element = self.element_box.currentText()
         self.setElementBox()
         self.filterElementBox()
-        if len(glb.model.get_all_names()[1:]) != 0:
+        if len(glb.model.get_element_index()) > 1:
             self.element_box.setCurrentText(element)
             self.plotCurrentElement()
         else:
@@ -404,15 +438,15 @@ class PhaseSpaceWindow(QWidget):
         self.element_box.blockSignals(True)
 
         self.element_box.clear()
-        elements = glb.model.get_element(name=glb.model.get_all_names())[1:]
-        for element in elements:
-            n = element['properties']['name']
-            t = element['properties']['type']
-            if t == self.type_box.currentText() or self.type_box.currentText() == 'all':
-                self.element_box.addItem(n)
-            elif self.type_box.currentText() == 'magnetic':
-                if t != 'drift':
-                    self.element_box.addItem(n)
+        elements = glb.model.get_all_elements()[1:]
+        filter_text = self.type_box.currentText()
+        if filter_text == 'all':
+            names = [element['properties']['name'] for element in elements]
+        elif filter_text == 'magnetic':
+            names = [element['properties']['name'] for element in elements if element['properties']['type'] != 'drift']
+        else:
+            names = [glb.model.get_element_by_index(i)['properties']['name'] for i in glb.model.get_indexes_by_type(filter_text)]
+        self.element_box.addItems(names)
         if len(elements) != 0:
             self.plotCurrentElement()
 
@@ -421,6 +455,7 @@ class PhaseSpaceWindow(QWidget):
         
 class OptimizationWindow(QWidget):
     def __init__(self, parent=None):
+        from classes.canvases import ConvergenceCanvas
         from classes.tables import NelderEvoTables
         from classes.trees import TargetSelect
 
@@ -429,6 +464,14 @@ class OptimizationWindow(QWidget):
         self.setLayout(QHBoxLayout())
         
         self.select_window = OptimizationSelectElementWindow(self)
+        self.process = None
+        self.queue = None
+        self.cancel_event = None
+        self.knobs = None
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setInterval(100)
+        self.poll_timer.timeout.connect(self.pollOptimization)
+        glb.app.aboutToQuit.connect(self.stopOptimization)
         
         # dividing workspace into parts
         ws_left = QWidget()
@@ -453,12 +496,25 @@ class OptimizationWindow(QWidget):
         
         # ws_right
         self.target_select = TargetSelect()
-        opt_button = QPushButton('Optimize')
-
-        opt_button.clicked.connect(self.optimize)
-
+        self.convergence_canvas = ConvergenceCanvas()
+        self.progress_label = QLabel('Iteration: --    Best cost: --')
+        self.opt_button = QPushButton('Optimize')
+        self.cancel_button = QPushButton('Cancel')
+        buttons = QWidget()
+        buttons.setLayout(QHBoxLayout())
+
+        self.convergence_canvas.setMinimumHeight(150)
+        self.cancel_button.setEnabled(False)
+        self.opt_button.clicked.connect(self.optimize)
+        self.cancel_button.clicked.connect(self.cancelOptimization)
+
+        buttons.layout().setContentsMargins(0, 0, 0, 0)
+        buttons.layout().addWidget(self.opt_button)
+        buttons.layout().addWidget(self.cancel_button)
         ws_right.layout().addWidget(self.target_select)
-        ws_right.layout().addWidget(opt_button)
+        ws_right.layout().addWidget(self.convergence_canvas)
+        ws_right.layout().addWidget(self.progress_label)
+        ws_right.layout().addWidget(buttons)
 
         # making adjustable
         splitter = QSplitter()
@@ -467,6 +523,7 @@ class OptimizationWindow(QWidget):
         
         # finalizing
         self.layout().addWidget(splitter)
+        self.refresh()  # built on first use, after the model was loaded
 
     def open(self):
         self.setWindowState(self.windowState() & ~Qt.WindowMinimized | Qt.WindowActive) # restoring to maximized/normal state
@@ -478,6 +535,7 @@ class OptimizationWindow(QWidget):
         self.select_window.clear()
         self.target_label.setText('Target: --')
 
+    @timed('OptimizationWindow.refresh')
     def refresh(self, new_file=False):
         if new_file:
             self.clear()
@@ -485,6 +543,12 @@ class OptimizationWindow(QWidget):
         self.select_window.refresh()
 
     def optimize(self):
+        from classes.model import serialize_model
+        from classes.optimization import optimize
+
+        if self.process is not None:  # one optimization at a time
+            return
+
         target_params = self.getTargetParams()
         
         if len(target_params) == 0:
@@ -549,87 +613,127 @@ class OptimizationWindow(QWidget):
                 warning.close()
                 return
             
-        global _costGeneric  # for pickle
-        def _costGeneric(x, k, o):
-            
-            for i, name in enumerate(k.keys()):
-                if name in glb.data['element']['beam state'].keys():
-                    print(k[name], x[i])
-                    for_set_twiss = ['beam size', 'twiss beta', 'alpha', 'geom. emittance', 'norm. emittance']
-                    if any(ext in name for ext in for_set_twiss):
-                            if 'beam size' in name:
-                                kwargs = {'rmssize': x[i]}
-                            elif 'twiss beta' in name:
-                                kwargs = {'beta': x[i]}
-                            elif 'alpha' in name:
-                                kwargs = {'alpha': x[i]}
-                            elif 'geom. emittance' in name:
-                                kwargs = {'emittance': x[i]}
-                            else:
-                                kwargs = {'nemittance': x[i]}
-                                
-                            glb.model.bmstate.set_twiss(name[:1], **kwargs)   
-                            continue         
-                            
-                    setattr(glb.model.bmstate, k[name]['abbreviation'], x[i]) 
-                else:
-                    glb.model.reconfigure(n, {k[name]: x[i]})
-            r, s = glb.model.run(to_element=o['location'])
-            dif = []
-            t = o['target']
-            for n, v in zip(t.keys(), t.values()):
-                if isinstance(v, (list, tuple)):
-                    val = getattr(s, n) * v[1] - v[0]
-                elif isinstance(v, (int, float)):
-                    val = getattr(s, n) - v
-                else:
-                    val = 0.0
-                dif.append(val)
-            dif = np.asarray(dif)
-            return sum(dif * dif)
-        
-        glb.main_window.menuBar().copyModelToHistory()
-        executor = ThreadPoolExecutor(max_workers=None)
-        
         if current_table is self.tables.nelder:
-            array = []
+            x0 = []
             for n in knobs.keys():
                 if n not in glb.data['element']['beam state'].keys():
-                    print('no beam state:', knobs[n])
-                    array.append(glb.model.get_element(name=n)[0]['properties'][knobs[n]])
+                    x0.append(glb.model.get_element_by_name(n)['properties'][knobs[n]])
                 else:
-                    print('yes beam state:', knobs[n])
-                    array.append(getattr(glb.model.bmstate, knobs[n]['abbreviation']))
-                    
-            x0 = np.array(array)
-            ans = executor.submit(minimize, fun=_costGeneric, x0=x0, args=(knobs, obj), method='Nelder-Mead')
-            ans = ans.result()
+                    x0.append(getattr(glb.model.bmstate, knobs[n]['abbreviation']))
+            problem = {'method': 'Nelder-Mead', 'x0': x0}
         else:
-            x0 = []
+            bounds = []
             for i in range(self.tables.evo.rowCount()):
                 low = float(self.tables.evo.cellWidget(i, 2).text())
                 high = float(self.tables.evo.cellWidget(i, 3).text())
-                x0.append((low, high))
+                bounds.append((low, high))
+            problem = {'method': 'Differential Evolution', 'bounds': bounds,
+                       'vectorized': self.tables.evo_vectorized.isChecked()}
+
+        problem.update({'conf': serialize_model(glb.model), 'knobs': knobs, 'obj': obj,
+                        'cache_size': glb.cost_cache_size,
+                        'cache_tol': glb.cost_cache_tol})
+
+        # spawn rather than fork: the GUI process holds Qt and simulation threads
+        ctx = mp.get_context('spawn')
+        self.knobs = knobs
+        self.queue = ctx.Queue()
+        self.cancel_event = ctx.Event()
+        self.process = ctx.Process(target=optimize, args=(problem, self.queue, self.cancel_event))
+        self.process.start()
+        profiler.begin_action('optimize')
+
+        self.convergence_canvas.clear()
+        self.progress_label.setText('Iteration: 0    Best cost: --')
+        self.opt_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.poll_timer.start()
+
+    def cancelOptimization(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.cancel_button.setEnabled(False)
+            self.progress_label.setText(self.progress_label.text() + '    (cancelling)')
+
+    def stopOptimization(self):
+        if self.process is not None:
+            self.cancel_event.set()
+            self.process.join(1.0)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.poll_timer.stop()
+            self.process = None
+
+    def pollOptimization(self):
+        from queue import Empty
+
+        msg = None
+        while True:
+            try:
+                msg = self.queue.get_nowait()
+            except Empty:
+                break
+            if msg[0] == 'profile':  # the optimizer process's timings, just before its final message
+                profiler.merge(msg[1])
+                continue
+            if msg[0] != 'progress':
+                break
+            iteration, best_cost, best_x = msg[1:]
+            self.convergence_canvas.addPoint(iteration, best_cost)
+            self.progress_label.setText('Iteration: {}    Best cost: {:.6g}'.format(iteration, best_cost))
+            self.progress_label.setToolTip('Best x: ' + ', '.join('{:.6g}'.format(v) for v in best_x))
+
+        if msg is not None and msg[0] != 'progress':
+            self.finishOptimization(msg)
+        elif not self.process.is_alive() and self.queue.empty():
+            self.finishOptimization(('error', 'Optimizer process exited with code {}.'.format(self.process.exitcode)))
+
+    def finishOptimization(self, msg):
+        from classes.optimization import apply_knobs
+
+        self.poll_timer.stop()
+        self.process.join()
+        self.process = None
+        self.opt_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+
+        if msg[0] == 'error':
+            warning = QMessageBox()
+            warning.setIcon(QMessageBox.Critical)
+            warning.setText("Optimization failed.")
+            warning.setDetailedText(msg[1])
+            warning.setWindowTitle("ERROR")
+            warning.setStandardButtons(QMessageBox.Ok)
+            if warning.exec() == QMessageBox.Ok:
+                warning.close()
+            return
 
-            # currently executing on the same thread
-            #ans = executor.submit(_differential_evolution, func=_costGeneric, x0=x0, args=(knobs, obj), workers=1)
-            ans = executor.submit(differential_evolution, func=_costGeneric, bounds=x0, args=(knobs, obj), workers=-1)
-            ans = ans.result()
-            
-        glb.main_window.refresh()
+        status, best_x, best_cost, summary, cache_stats = msg
+        if best_x is not None:
+            glb.main_window.menuBar().copyModelToHistory('apply optimization')
+            apply_knobs(glb.model, self.knobs, best_x)
+            glb.main_window.refresh()
 
         popup = QMessageBox()
         popup.setIcon(QMessageBox.Information)
-        popup.setText("Model has been optimized.")
-        popup.setDetailedText(str(ans))
-        popup.setWindowTitle("SUCCESS")
+        if status == 'done':
+            popup.setText("Model has been optimized.")
+            popup.setWindowTitle("SUCCESS")
+        else:
+            popup.setText("Optimization cancelled. The best result found so far has been applied.")
+            popup.setWindowTitle("CANCELLED")
+        if cache_stats:
+            lookups = cache_stats['hits'] + cache_stats['misses']
+            popup.setInformativeText('Cost cache: {} hits, {} misses ({:.1%} hit rate)'.format(
+                cache_stats['hits'], cache_stats['misses'], cache_stats['hits'] / lookups if lookups else 0.0))
+        popup.setDetailedText(summary)
         popup.setStandardButtons(QMessageBox.Ok)
 
         te = popup.findChild(QTextEdit)
         te.setLineWrapMode(QTextEdit.NoWrap)
         width = te.document().idealWidth() + te.document().documentMargin() + \
             te.verticalScrollBar().width()
-        te.parent().setFixedWidth(width)
+        te.parent().setFixedWidth(int(width))
 
         if popup.exec() == QMessageBox.Ok:
             popup.close()
@@ -735,7 +839,7 @@ class OptimizationSelectElementWindow(QWidget):
         self.parent().tables.fill()
         target_index = self.data['target']
         if target_index:
-            target = glb.model.get_element(index=target_index)[0]['properties']['name']
+            target = glb.model.get_element_by_index(target_index)['properties']['name']
             self.parent().target_label.setText('Target: ' + target)
         else:
             self.parent().target_label.setText('Target: --')
@@ -761,11 +865,10 @@ class OptimizationSelectElementWindow(QWidget):
 
         # element removal
         rows_to_remove = []
-        names = glb.model.get_all_names()[1:]
         for i in range(self.element_table.rowCount()):
             item = self.element_table.item(i, 2)
             name = item.text()
-            if name not in names:
+            if not glb.model.has_element_name(name):
                 rows_to_remove.append(i)
                 if item.element_index in self.data['knobs']['elements']:
                     self.data['knobs']['elements'].remove(item.element_index)
@@ -777,14 +880,15 @@ class OptimizationSelectElementWindow(QWidget):
             self.element_table.removeRow(row_num)
             
         # element addition
-        current_elements = []
+        current_elements = set()
         for i in range(self.element_table.rowCount()):
             item = self.element_table.item(i, 2)
-            current_elements.append(item.text())
+            current_elements.add(item.text())
 
+        names = glb.model.get_all_names()[1:]
         for name in names:
             if name not in current_elements:
-                element = glb.model.get_element(name=name)[0]
+                element = glb.model.get_element_by_name(name)
                 element_index = element['index']
             
                 knob_widget = QWidget()
@@ -816,7 +920,7 @@ class OptimizationSelectElementWindow(QWidget):
                 self.adjustDataIndexesBeyond(element_index, removal=True)
 
     def adjustDataIndexesBeyond(self, index, removal=False):
-        if len(glb.model.get_all_names()[1:]) == 0:
+        if len(glb.model.get_element_index()) <= 1:  # only the source element
             return
 
         # In element removal, allows us to adjust data['target'] += 1, without
@@ -825,7 +929,7 @@ class OptimizationSelectElementWindow(QWidget):
         # Note: this is not the case for element addition, hence the boolean.
         for i in sorted(range(self.element_table.rowCount())[index:], reverse=removal):
             item = self.element_table.item(i, 2)
-            n_index = glb.model.get_element(name=item.text())[0]['index']
+            n_index = glb.model.get_indexes_by_name(item.text())[0]
             try:
                 knob_checkbox = self.element_table.cellWidget(i, 0).children()[1]
             except: # for items without knobs
@@ -853,7 +957,7 @@ class OptimizationSelectElementWindow(QWidget):
         element_name = table.item(i.row(), name_column).text()
 
         if table is self.element_table:
-            element_index = glb.model.get_index_by_name(name=element_name)[element_name][0]
+            element_index = glb.model.get_indexes_by_name(element_name)[0]
         
         checkbox.blockSignals(True)
         if state == Qt.Unchecked:
@@ -896,7 +1000,7 @@ class OptimizationSelectElementWindow(QWidget):
                             checkbox.blockSignals(False)
                             return
                 if self.data['target']:
-                    target_name = glb.model.get_element(index=self.data['target'])[0]['properties']['name']
+                    target_name = glb.model.get_element_by_index(self.data['target'])['properties']['name']
                     for i in range(self.element_table.rowCount()):
                         name = self.element_table.item(i, name_column).text()
                         if name == target_name:
@@ -938,7 +1042,7 @@ class OptimizationSelectElementWindow(QWidget):
             
         # element table
         for name in names:
-            element = glb.model.get_element(name=name)[0]
+            element = glb.model.get_element_by_name(name)
             
             knob_widget = QWidget()
             target_widget = QWidget()
@@ -969,6 +1073,114 @@ class OptimizationSelectElementWindow(QWidget):
 
 
         
+class PerformanceWindow(QWidget):
+    def __init__(self, parent=None):
+        from classes.tables import Table
+
+        super().__init__(parent=parent)
+        self.setWindowTitle('Performance')
+        self.setLayout(QVBoxLayout())
+        self.resize(700, 600)
+
+        # objects
+        self.runs_label = QLabel()
+        self.stats_table = Table(0, 5)
+        self.actions_table = Table(0, 3)
+        reset_button = QPushButton('Reset')
+        self.trace_button = QPushButton('Record Trace')
+        save_trace_button = QPushButton('Save Trace...')
+        buttons = QWidget()
+        buttons.setLayout(QHBoxLayout())
+        self.timer = QTimer(self)  # updates while the window is shown
+
+        self.stats_table.setHorizontalHeaderLabels(['Function', 'Calls', 'Total [ms]', 'Mean [ms]', 'Max [ms]'])
+        self.stats_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeToContents)
+        self.actions_table.setHorizontalHeaderLabels(['Action', 'FLAME Runs', 'Started'])
+        self.timer.setInterval(500)
+
+        self.trace_button.setCheckable(True)
+        self.trace_button.setChecked(profiler.tracing)
+        self.trace_button.setToolTip('Keep every timed call for a Chrome trace file (chrome://tracing, ui.perfetto.dev)')
+
+        self.timer.timeout.connect(self.refresh)
+        reset_button.clicked.connect(self.reset)
+        self.trace_button.toggled.connect(self.toggleTracing)
+        save_trace_button.clicked.connect(self.saveTrace)
+
+        # finalizing
+        buttons.layout().setContentsMargins(0, 0, 0, 0)
+        buttons.layout().addWidget(reset_button)
+        buttons.layout().addWidget(self.trace_button)
+        buttons.layout().addWidget(save_trace_button)
+        self.layout().addWidget(self.runs_label)
+        self.layout().addWidget(self.stats_table, 3)
+        self.layout().addWidget(QLabel('Recent actions:'))
+        self.layout().addWidget(self.actions_table, 2)
+        self.layout().addWidget(buttons)
+
+    def open(self):
+        self.setWindowState(self.windowState() & ~Qt.WindowMinimized | Qt.WindowActive) # restoring to maximized/normal state
+        self.activateWindow()
+        self.show()
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start()
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super().hideEvent(event)
+
+    def refresh(self):
+        text = 'FLAME runs: {}'.format(profiler.runs)
+        if profiler.tracing:
+            text += '    Trace events: {}'.format(len(profiler.events))
+        self.runs_label.setText(text)
+        self.trace_button.blockSignals(True)  # tracing may also be started with --trace
+        self.trace_button.setChecked(profiler.tracing)
+        self.trace_button.blockSignals(False)
+
+        rows = profiler.table()
+        self.stats_table.setRowCount(len(rows))
+        for i, (name, calls, total, mean, longest) in enumerate(rows):
+            values = [name, str(calls)] + ['{:.1f}'.format(t * 1e3) for t in (total, mean, longest)]
+            for j, value in enumerate(values):
+                self.stats_table.setItem(i, j, QTableWidgetItem(value))
+
+        actions = profiler.recent_actions()
+        self.actions_table.setRowCount(len(actions))
+        for i, (label, runs, started) in enumerate(actions):
+            values = [label, str(runs), time.strftime('%H:%M:%S', time.localtime(started))]
+            for j, value in enumerate(values):
+                self.actions_table.setItem(i, j, QTableWidgetItem(value))
+
+    def reset(self):
+        profiler.reset()
+        self.refresh()
+
+    def toggleTracing(self, checked):
+        if checked:
+            profiler.start_tracing()
+        else:
+            profiler.stop_tracing()
+        self.refresh()
+
+    def saveTrace(self):
+        filename = QFileDialog.getSaveFileName(self, "Save Trace", "trace.json", "Chrome Trace (*.json)")[0]
+        if filename:
+            try:
+                profiler.write_trace(filename)
+            except OSError as e:
+                warning = QMessageBox()
+                warning.setIcon(QMessageBox.Critical)
+                warning.setText("Could not save " + filename)
+                warning.setInformativeText(str(e))
+                warning.setWindowTitle("ERROR")
+                warning.setStandardButtons(QMessageBox.Ok)
+                warning.exec()
+
+
 class PreferenceWindow(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent=parent)
@@ -981,15 +1193,31 @@ class PreferenceWindow(QWidget):
         app_fsize_label = QLabel('Application Font Size:')
         plt_fsize_label = QLabel('Plot Font Size:')
         sigfig_label = QLabel('Significant Figures:')
+        cache_size_label = QLabel('Optimizer Cost Cache Size:')
+        cache_tol_label = QLabel('Optimizer Cost Cache Tolerance:')
+        history_label = QLabel('Undo History Memory [MB]:')
+        snapshot_label = QLabel('Snapshot Memory [MB]:')
         self.app_fsize_spin = QSpinBox()
         self.plt_fsize_spin = QSpinBox()
         self.sigfig_spin = QSpinBox()
+        self.cache_size_spin = QSpinBox()
+        self.cache_tol_edit = QLineEdit()
+        self.history_spin = QSpinBox()
+        self.snapshot_spin = QSpinBox()
         default_button = QPushButton('Default')
         apply_button = QPushButton('Apply')
         
         self.app_fsize_spin.setValue(settings['AppFontSize'])
         self.plt_fsize_spin.setValue(settings['PlotFontSize'])
         self.sigfig_spin.setValue(settings['NumSigFigs'])
+        self.cache_size_spin.setRange(0, 10000000)
+        self.cache_size_spin.setValue(settings['CostCacheSize'])
+        self.cache_tol_edit.setValidator(QDoubleValidator(0.0, 1e300, 17))
+        self.cache_tol_edit.setText(str(settings['CostCacheTol']))
+        self.history_spin.setRange(1, 1000000)
+        self.history_spin.setValue(settings['HistoryMaxMB'])
+        self.snapshot_spin.setRange(1, 1000000)
+        self.snapshot_spin.setValue(settings['SnapshotMaxMB'])
 
         default_button.clicked.connect(self.setDefault)
         apply_button.clicked.connect(self.apply)
@@ -998,11 +1226,19 @@ class PreferenceWindow(QWidget):
         self.layout().addWidget(app_fsize_label, 0, 0)
         self.layout().addWidget(plt_fsize_label, 1, 0)
         self.layout().addWidget(sigfig_label, 2, 0)
-        self.layout().addWidget(default_button, 3, 0)
+        self.layout().addWidget(cache_size_label, 3, 0)
+        self.layout().addWidget(cache_tol_label, 4, 0)
+        self.layout().addWidget(history_label, 5, 0)
+        self.layout().addWidget(snapshot_label, 6, 0)
+        self.layout().addWidget(default_button, 7, 0)
         self.layout().addWidget(self.app_fsize_spin, 0, 1)
         self.layout().addWidget(self.plt_fsize_spin, 1, 1)
         self.layout().addWidget(self.sigfig_spin, 2, 1)
-        self.layout().addWidget(apply_button, 3, 1)
+        self.layout().addWidget(self.cache_size_spin, 3, 1)
+        self.layout().addWidget(self.cache_tol_edit, 4, 1)
+        self.layout().addWidget(self.history_spin, 5, 1)
+        self.layout().addWidget(self.snapshot_spin, 6, 1)
+        self.layout().addWidget(apply_button, 7, 1)
 
     def open(self):
         self.setWindowState(self.windowState() & ~Qt.WindowMinimized | Qt.WindowActive) # restoring to maximized/normal state
@@ -1018,6 +1254,17 @@ class PreferenceWindow(QWidget):
 
         # significant figures
         glb.num_sigfigs = self.sigfig_spin.value()
+
+        # optimizer cost cache
+        glb.cost_cache_size = self.cache_size_spin.value()
+        try:
+            glb.cost_cache_tol = float(self.cache_tol_edit.text())
+        except ValueError:
+            self.cache_tol_edit.setText(str(glb.cost_cache_tol))
+
+        # undo/redo journal
+        glb.history_max_mb = self.history_spin.value()
+        glb.snapshot_max_mb = self.snapshot_spin.value()
         
         glb.main_window.refresh()
 
@@ -1025,6 +1272,10 @@ class PreferenceWindow(QWidget):
         self.app_fsize_spin.setValue(9)
         self.plt_fsize_spin.setValue(10)
         self.sigfig_spin.setValue(4)
+        self.cache_size_spin.setValue(10000)
+        self.cache_tol_edit.setText('1e-09')
+        self.history_spin.setValue(64)
+        self.snapshot_spin.setValue(32)
         
     def setSettings(self):
         config = ConfigParser()
@@ -1032,6 +1283,10 @@ class PreferenceWindow(QWidget):
         config.set('main', 'AppFontSize', str(self.app_fsize_spin.value()))
         config.set('main', 'PlotFontSize', str(self.plt_fsize_spin.value()))
         config.set('main', 'NumSigFigs', str(self.sigfig_spin.value()))
+        config.set('main', 'CostCacheSize', str(self.cache_size_spin.value()))
+        config.set('main', 'CostCacheTol', self.cache_tol_edit.text())
+        config.set('main', 'HistoryMaxMB', str(self.history_spin.value()))
+        config.set('main', 'SnapshotMaxMB', str(self.snapshot_spin.value()))
         with open('settings.ini','w') as f:
             config.write(f)
         
@@ -1041,9 +1296,17 @@ class PreferenceWindow(QWidget):
         app_fsize = config.getint('main', 'AppFontSize')
         plt_fsize = config.getint('main', 'PlotFontSize')
         num_sigfigs = config.getint('main', 'NumSigFigs')
+        cache_size = config.getint('main', 'CostCacheSize', fallback=10000)
+        cache_tol = config.getfloat('main', 'CostCacheTol', fallback=1e-9)
+        history_max_mb = config.getint('main', 'HistoryMaxMB', fallback=64)
+        snapshot_max_mb = config.getint('main', 'SnapshotMaxMB', fallback=32)
         return {'AppFontSize': app_fsize,
                 'PlotFontSize': plt_fsize,
-                'NumSigFigs': num_sigfigs}
+                'NumSigFigs': num_sigfigs,
+                'CostCacheSize': cache_size,
+                'CostCacheTol': cache_tol,
+                'HistoryMaxMB': history_max_mb,
+                'SnapshotMaxMB': snapshot_max_mb}
 
 
 class ModelElementConfigWindow(QWidget):
@@ -1104,7 +1367,7 @@ class ModelElementConfigWindow(QWidget):
         self.index_spin.setEnabled(False)
         self.type_box.setEnabled(False)
 
-        element = glb.model.get_element(index=element_index)[0]
+        element = glb.model.get_element_by_index(element_index)
 
         self.index_spin.setValue(element_index)
         self.name_line.setText(element['properties']['name'])
@@ -1124,7 +1387,7 @@ class ModelElementConfigWindow(QWidget):
         self.attr_table.setRequiredAttributes(self.type_box.currentText())
         
     def updateIndexSpinBox(self):
-        num_elements = len(glb.model.get_all_names()[1:])
+        num_elements = len(glb.model.get_element_index()) - 1
         self.index_spin.setRange(1, num_elements + 1)
 
     def apply(self):
@@ -1158,7 +1421,7 @@ class ModelElementConfigWindow(QWidget):
         d['type'] = self.type_box.currentText()
         i = self.index_spin.value()
 
-        glb.main_window.menuBar().copyModelToHistory()
+        glb.main_window.menuBar().copyModelToHistory('insert element' if self.type_box.isEnabled() else 'edit element')
 
         if self.type_box.isEnabled() == False:
             glb.model.pop_element(index=i)
@@ -1190,7 +1453,7 @@ class EditMatrixWindow(QWidget):
         self.show()
         
     def setMatrix(self):
-        glb.main_window.menuBar().copyModelToHistory()
+        glb.main_window.menuBar().copyModelToHistory('edit matrix')
         glb.model.reconfigure(self.element_name, {'matrix': self.table.getMatrix()})
         glb.main_window.refresh()
         self.close()
@@ -0,0 +1,185 @@
+import threading
+
+from PyQt5.QtCore import QMutex, QThread, QWaitCondition, pyqtSignal
+
+
+class MachineReplica:
+    # the simulation worker's own copy of a model's machine, brought up to the revision of each run
+    # by replaying the model's edit log (Model.edit_log), so the GUI thread does not clone the whole
+    # machine for every request
+    def __init__(self, log, length, machine):
+        from flame_utils import ModelFlame
+
+        self.log = log
+        self.length = length
+        self.model = ModelFlame(machine=machine)
+
+    def machine_for(self, run):
+        from flame_utils import ModelFlame
+
+        if run.edit_log is not self.log or run.edits < self.length:
+            raise RuntimeError('no copy of the machine of this run')
+        for method, kwargs in self.log[self.length:run.edits]:
+            getattr(ModelFlame, method)(self.model, **kwargs)
+        self.length = run.edits
+        return self.model.machine
+
+
+class SimulationWorker(QThread):
+    resultReady = pyqtSignal(object)  # finished FullRun, to be installed with Model.install_full_run()
+
+    chunk_size = 200  # elements propagated between checks for a newer request
+
+    def __init__(self, parent=None):
+        super().__init__(parent=parent)
+        self._mutex = QMutex()
+        self._condition = QWaitCondition()
+        self._pending = None
+        self._current = None
+        self._stopped = False
+        self._replica = None  # MachineReplica, only used by the worker thread
+        self._base = None  # (log, length, machine) to start a new replica from
+        self._replica_log = None  # edit log the worker has, or is given, a replica for
+
+    def request(self, model):
+        # only the latest request is kept: a queued one is dropped and a running one is cancelled.
+        # The machine is only cloned here when the worker has no replica of it yet, e.g. for a new model
+        from classes.model import FullRun
+
+        run = FullRun(model, chunk_size=self.chunk_size, deferred=True)
+
+        self._mutex.lock()
+        known = self._replica_log is run.edit_log
+        self._mutex.unlock()
+        base = None if known else (run.edit_log, run.edits, model.clone_machine())
+
+        self._mutex.lock()
+        if base is not None:
+            self._base = base
+            self._replica_log = run.edit_log
+        if self._current is not None:
+            self._current.cancelled = True
+        self._pending = run
+        self._condition.wakeOne()
+        self._mutex.unlock()
+
+    def adoptMachine(self, run):
+        # takes the machine of a run executed elsewhere, e.g. the lattice loader's first run, as the
+        # replica for its model, unless the worker has one already or a request of another model is queued
+        self._mutex.lock()
+        if self._replica_log is not run.edit_log and (self._pending is None or self._pending.edit_log is run.edit_log):
+            self._base = (run.edit_log, run.edits, run.model.machine)
+            self._replica_log = run.edit_log
+        self._mutex.unlock()
+
+    def isIdle(self):
+        self._mutex.lock()
+        idle = self._pending is None and self._current is None
+        self._mutex.unlock()
+        return idle
+
+    def stop(self):
+        self._mutex.lock()
+        self._stopped = True
+        if self._current is not None:
+            self._current.cancelled = True
+        self._condition.wakeOne()
+        self._mutex.unlock()
+        self.wait()
+
+    def run(self):
+        threading.current_thread().name = 'SimulationWorker'  # as shown in traces
+        while True:
+            self._mutex.lock()
+            while self._pending is None and not self._stopped:
+                self._condition.wait(self._mutex)
+            if self._stopped:
+                self._mutex.unlock()
+                return
+            run, self._pending = self._pending, None
+            base, self._base = self._base, None
+            self._current = run
+            self._mutex.unlock()
+
+            try:
+                if base is not None:
+                    self._replica = MachineReplica(*base)
+                if self._replica is None:
+                    raise RuntimeError('no copy of the machine of this run')
+                run.use_machine(self._replica.machine_for(run))
+                run = run.execute()
+            except Exception as e:  # leave the GUI to simulate synchronously
+                print('Simulation failed: ' + str(e))
+                run = None
+                self._replica = None
+                self._mutex.lock()
+                if self._base is None:  # the next request clones the machine again
+                    self._replica_log = None
+                self._mutex.unlock()
+
+            if run is not None and not run.cancelled:
+                self.resultReady.emit(run)
+
+            self._mutex.lock()
+            self._current = None
+            self._mutex.unlock()
+
+
+class LatticeLoader(QThread):
+    # opens a lattice file in stages: parse, build the machine, build the element index, run the first
+    # simulation. The model is handed over before the simulation so it can be browsed meanwhile.
+    progress = pyqtSignal(str, int, int)  # stage description, steps done, total steps
+    modelReady = pyqtSignal(object)  # Model
+    resultReady = pyqtSignal(object)  # first FullRun, to be installed with Model.install_full_run()
+    failed = pyqtSignal(str)
+
+    chunk_size = 200
+
+    def __init__(self, filename, parent=None):
+        super().__init__(parent=parent)
+        self.filename = filename
+        self.cancelled = False
+        self.model = None  # set once handed over
+        self._run = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self._run is not None:
+            self._run.cancelled = True
+
+    def run(self):
+        from flame import Machine
+        from classes.lattice import load_conf, model_from_conf
+        from classes.model import FullRun
+
+        threading.current_thread().name = 'LatticeLoader'
+        try:
+            self.progress.emit('Parsing lattice...', 0, 0)
+            conf = load_conf(self.filename)
+            if self.cancelled:
+                return
+            self.progress.emit('Building machine...', 0, 0)
+            model = model_from_conf(conf)
+            if self.cancelled:
+                return
+            self.progress.emit('Indexing {} elements...'.format(len(model.machine)), 0, 0)
+            model.get_element_index()
+
+            # The first run is set up before the hand-over, so it needs a machine of its own; running it
+            # before would keep the lattice closed for the whole simulation (4.2 s against 0.32 s to
+            # build a machine at 10k elements, and a clone takes 0.88 s). Once done, the machine
+            # becomes the simulation worker's replica of the model's (SimulationWorker.adoptMachine)
+            self._run = FullRun(model, chunk_size=self.chunk_size, machine=Machine(conf))
+            self._run.progress = lambda done, last: self.progress.emit('Simulating...', done, last)
+            if self.cancelled:
+                return
+            self.model = model
+            self.modelReady.emit(model)
+            run = self._run.execute()
+        except Exception as e:
+            if not self.cancelled:
+                self.failed.emit(str(e))
+            return
+
+        if run is not None and not self.cancelled:
+            self.resultReady.emit(run)
@@ -1,17 +1,38 @@
 from sys import argv
 
 import numpy as np
-from PyQt5.QtWidgets import QApplication
-
-from classes.model import Model
 
 global app
 global num_sigfigs
+global cost_cache_size
+global cost_cache_tol
+global history_max_mb
+global snapshot_max_mb
 global model
+global main_window
 global data
-app = QApplication(argv)
 num_sigfigs = 4
-model = Model()
+cost_cache_size = 10000  # optimizer cost evaluations kept, 0 disables the cache
+cost_cache_tol = 1e-9  # knob vectors closer than this share a cached cost
+history_max_mb = 64  # memory cap of the undo/redo journal
+snapshot_max_mb = 32  # memory cap of the named snapshot store
+main_window = None
+
+
+def __getattr__(name):
+    # 'app' and 'model' are created on first use, so importing this module stays cheap
+    # and does not load Qt or flame_utils
+    global app, model
+    if name == 'app':
+        from PyQt5.QtWidgets import QApplication
+        app = QApplication(argv)
+        return app
+    if name == 'model':
+        from classes.model import Model
+        model = Model()
+        return model
+    raise AttributeError("module 'globals' has no attribute " + repr(name))
+
 data = {'element': {'model': {},
                     'beam state': {'Q/A': {'abbreviation': 'ref_IonZ'},
                                    'energy': {'abbreviation': 'ref_IonEk'},
@@ -1,10 +1,54 @@
+# imports stay under the guard: optimizer processes are spawned and re-import
+# this module, and must not create a QApplication or a Model of their own
+if __name__ == '__main__':
+    import sys
+    import time
 
-from PyQt5.QtWidgets import QApplication
+    if sys.argv[1:2] == ['batch']:  # headless: neither PyQt5 nor a Qt matplotlib backend is loaded
+        import os
+        os.environ.setdefault('MPLBACKEND', 'Agg')
+        from classes.batch import main
+        sys.exit(main(sys.argv[2:]))
 
-import globals as glb
-from classes.windows import MainWindow
+    # --timing prints how long each startup stage took
+    timing = '--timing' in sys.argv
+    if timing:
+        sys.argv.remove('--timing')
+    # --trace FILE records the session's timed calls to a Chrome trace file, written on exit
+    trace_file = None
+    if '--trace' in sys.argv[:-1]:
+        i = sys.argv.index('--trace')
+        trace_file = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
+    stages = [('', time.perf_counter())]
 
-if __name__ == '__main__':
-    window = MainWindow()
-    window.show()
+    import globals as glb
+    stages.append(('globals', time.perf_counter()))
+    glb.app
+    stages.append(('QApplication', time.perf_counter()))
+    if trace_file:
+        from classes.profiling import profiler
+        profiler.start_tracing()
+        glb.app.aboutToQuit.connect(lambda: profiler.write_trace(trace_file))
+    from PyQt5.QtCore import QTimer
+    from classes.windows import MainWindow
+    stages.append(('GUI modules', time.perf_counter()))
+
+    glb.main_window = MainWindow()
+    stages.append(('main window', time.perf_counter()))
+    glb.main_window.show()
+    glb.app.processEvents()
+    stages.append(('first window shown', time.perf_counter()))
+
+    def loadModel():
+        # the initial model, and flame_utils with it, is loaded once the window is up
+        glb.model
+        stages.append(('model', time.perf_counter()))
+        if timing:
+            print('startup timing [s]')
+            for (_, previous), (stage, t) in zip(stages, stages[1:]):
+                print('  {:<20}{:8.3f}'.format(stage, t - previous))
+            print('  {:<20}{:8.3f}'.format('total', stages[-1][1] - stages[0][1]))
+
+    QTimer.singleShot(0, loadModel)
     glb.app.exec()
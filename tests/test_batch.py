@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+from classes.batch import target_index
+from classes.lattice import open_model
+
+LATTICE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'PS_demo.lat')
+KNOBS = {'FS_F1S1:Q_D1013': 'B2'}
+
+
+@pytest.fixture(scope='module')
+def model():
+    return open_model(LATTICE, use_cache=False)
+
+
+def test_location_by_name_index_or_default(model):
+    knob = model.get_indexes_by_name('FS_F1S1:Q_D1013')[0]
+    assert target_index(model, KNOBS, None, 'optimization') == len(model.machine) - 1
+    assert target_index(model, KNOBS, knob + 1, 'optimization') == knob + 1
+    name = model.get_element_by_index(knob + 1)['properties']['name']
+    assert target_index(model, KNOBS, name, 'sweep') == model.get_indexes_by_name(name)[0]
+
+
+@pytest.mark.parametrize('location, message', [(1, 'at or beyond every knob'),
+                                               (10**6, 'outside the lattice'),
+                                               ('no_such_element', 'no element named')])
+def test_bad_location(model, location, message):
+    with pytest.raises(ValueError, match=message):
+        target_index(model, KNOBS, location, 'optimization')
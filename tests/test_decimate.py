@@ -0,0 +1,53 @@
+import numpy as np
+
+from classes.utility import decimate
+
+
+def series(n=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.random(n)), rng.normal(size=n)
+
+
+def test_keeps_extrema_of_every_bucket():
+    x, y = series()
+    buckets = 10
+    index = decimate(x, y, x[0], x[-1], buckets)
+    assert len(index) < len(x)
+    bucket = np.clip(np.floor((x - x[0]) * (buckets / (x[-1] - x[0]))).astype(int), 0, buckets - 1)
+    for b in range(buckets):
+        kept = y[index][bucket[index] == b]
+        assert kept.max() == y[bucket == b].max()
+        assert kept.min() == y[bucket == b].min()
+
+
+def test_nan_does_not_hide_peak_of_its_bucket():
+    x, y = series()
+    y[10] = np.nan  # the peaks are in the same bucket as the NaN
+    y[30] = 99.0
+    y[40] = -99.0
+    index = decimate(x, y, x[0], x[-1], 10)
+    assert 10 in index
+    assert 30 in index
+    assert 40 in index
+    assert np.nanmax(y[index]) == 99.0
+    assert np.nanmin(y[index]) == -99.0
+
+
+def test_all_nan():
+    x, y = series()
+    y[:] = np.nan
+    index = decimate(x, y, x[0], x[-1], 10)
+    assert np.array_equal(index, np.arange(len(x)))
+
+
+def test_view_range_keeps_one_point_beyond_each_end():
+    x, y = series()
+    index = decimate(x, y, x[200], x[800], 10)
+    assert index[0] == 199
+    assert index[-1] == 801
+    assert y[index].max() == y[199:802].max()
+
+
+def test_short_range_is_kept_whole():
+    x, y = series(30)
+    assert np.array_equal(decimate(x, y, x[0], x[-1], 10), np.arange(30))
@@ -0,0 +1,42 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+from classes import lattice
+from classes.lattice import CACHE_SUFFIX, parse_lattice, read_cache, write_cache
+
+LATTICE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'PS_demo.lat')
+
+
+@pytest.fixture
+def lattice_file(tmp_path):
+    path = str(tmp_path / 'PS_demo.lat')
+    shutil.copy(LATTICE, path)
+    return path
+
+
+def test_concurrent_writers(lattice_file, capsys):
+    stat = os.stat(lattice_file)
+    conf = parse_lattice(lattice_file)
+    threads = [threading.Thread(target=write_cache, args=(lattice_file, stat, conf)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 'Could not write' not in capsys.readouterr().out
+    assert sorted(os.listdir(os.path.dirname(lattice_file))) == ['PS_demo.lat', 'PS_demo.lat' + CACHE_SUFFIX]
+    assert read_cache(lattice_file, stat)[0] is not None
+
+
+def test_failed_write_leaves_no_temp_file(lattice_file, monkeypatch, capsys):
+    def fail(src, dst):
+        raise OSError('no space left')
+    monkeypatch.setattr(lattice.os, 'replace', fail)
+
+    write_cache(lattice_file, os.stat(lattice_file), parse_lattice(lattice_file))
+
+    assert 'Could not write lattice cache' in capsys.readouterr().out
+    assert os.listdir(os.path.dirname(lattice_file)) == ['PS_demo.lat']
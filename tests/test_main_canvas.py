@@ -0,0 +1,78 @@
+import os
+
+import matplotlib.image as mpimg
+import numpy as np
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import globals as glb
+from classes.canvases import MainCanvas
+from classes.lattice import open_model
+from classes.utility import Line
+
+LATTICE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'PS_demo.lat')
+
+
+class Result(dict):
+    # what canBlit reads of a model result
+    def __init__(self, pos, **columns):
+        super().__init__(pos=pos, **columns)
+        self.pos = pos
+
+
+@pytest.fixture
+def canvas():
+    glb.app
+    canvas = MainCanvas()
+    canvas.resize(640, 480)
+    ax = canvas.figure.subplots()
+    canvas.base_ax = ax
+    canvas.axes.append(ax)
+    ln = Line(np.linspace(0.0, 10.0, 200), np.sin(np.linspace(0.0, 10.0, 200)), 'xrms')
+    ln.set_color('#ff0000')
+    ln.set_linewidth(3)
+    ln.set_animated(canvas.use_blit)
+    ax.add_line(ln)
+    ax.relim()
+    ax.autoscale()
+    canvas.lines['xrms'] = ln
+    canvas.draw()
+    return canvas
+
+
+@pytest.mark.parametrize('fmt', ['png', 'pdf', 'svg'])
+def test_save_with_blit(canvas, tmp_path, monkeypatch, fmt):
+    assert canvas.use_blit
+    drawn_while_saving = []
+    draw_lines = canvas.drawLines
+
+    def drawLines():
+        drawn_while_saving.append(canvas.figure.canvas.is_saving())
+        draw_lines()
+    monkeypatch.setattr(canvas, 'drawLines', drawLines)
+
+    canvas.figure.savefig(tmp_path / ('figure.' + fmt), dpi=200)
+
+    assert not any(drawn_while_saving)
+    assert canvas.background_size == tuple(canvas.figure.bbox.size)  # taken from the screen
+    assert canvas.lines['xrms'].get_animated()
+
+
+def test_saved_png_contains_lines(canvas, tmp_path):
+    path = tmp_path / 'figure.png'
+    canvas.figure.savefig(path)
+    image = mpimg.imread(path)
+    red = (image[..., 0] > 0.9) & (image[..., 1] < 0.1) & (image[..., 2] < 0.1)
+    assert red.sum() > 100
+
+
+def test_blit_follows_the_layout_position(canvas, monkeypatch):
+    monkeypatch.setattr(glb, 'model', open_model(LATTICE, use_cache=False), raising=False)
+    canvas.plotLocation()
+    canvas.draw()
+    pos, y = canvas.lines['xrms'].full_x, canvas.lines['xrms'].full_y
+
+    assert canvas.canBlit(['xrms'], Result(pos, xrms=y))
+    # still inside the drawn view, but a lower minimum moves the layout further down
+    assert not canvas.canBlit(['xrms'], Result(pos, xrms=np.where(y < 0, y * 1.05, y)))
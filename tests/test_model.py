@@ -0,0 +1,16 @@
+import os
+
+from flame_utils import ModelFlame
+
+from classes.lattice import open_model
+
+LATTICE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'PS_demo.lat')
+
+
+def test_get_all_names_matches_flame_utils_after_edits():
+    model = open_model(LATTICE, use_cache=False)
+    model.pop_element(index=3)
+    model.insert_element(index=7, element={'name': 'extra_drift', 'type': 'drift', 'L': 0.1})
+    model.insert_element(index=20, element={'name': model.get_all_names()[2], 'type': 'drift', 'L': 0.1})
+    for element_type in (None, 'quadrupole', 'drift', 'no_such_type'):
+        assert model.get_all_names(element_type) == ModelFlame.get_all_names(model, element_type)
@@ -0,0 +1,33 @@
+import os
+import re
+from queue import SimpleQueue
+
+from classes import optimization
+from classes.lattice import open_model
+from classes.model import serialize_model
+
+LATTICE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'PS_demo.lat')
+
+
+def test_pool_polish_goes_through_the_tracker(monkeypatch):
+    records = []
+    record = optimization.CostTracker.record
+
+    def counting_record(self, x, cost):
+        records.append(cost)
+        record(self, x, cost)
+    monkeypatch.setattr(optimization.CostTracker, 'record', counting_record)
+
+    model = open_model(LATTICE, use_cache=False)
+    problem = {'method': 'Differential Evolution', 'bounds': [(-15, -10)], 'vectorized': False,
+               'conf': serialize_model(model), 'knobs': {'FS_F1S1:Q_D1013': 'B2'},
+               'obj': {'location': 40, 'target': {'xrms': [1.0, 1.0]}}, 'workers': 2, 'maxiter': 3,
+               'cache_size': 1000, 'cache_tol': 0.0}
+    queue = SimpleQueue()
+    optimization.optimize(problem, queue, None)
+    while not queue.empty():
+        msg = queue.get()
+
+    assert msg[0] == 'done'
+    nfev = int(re.search(r'nfev: (\d+)', msg[3]).group(1))
+    assert len(records) + msg[4]['hits'] == nfev  # the polish is recorded like the population
@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import pytest
+
+from classes.lattice import open_model
+from classes.model import FullRun
+from classes.workers import MachineReplica, SimulationWorker
+
+LATTICE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'PS_demo.lat')
+
+
+@pytest.fixture
+def model():
+    return open_model(LATTICE, use_cache=False)
+
+
+def edit(model):
+    quad = model.get_indexes_by_type('quadrupole')[0]
+    b2 = model.get_element_by_index(quad)['properties']['B2']
+    model.reconfigure(quad, {'B2': b2 * 1.1})
+    model.insert_element(index=5, element={'name': 'extra_drift', 'type': 'drift', 'L': 0.25})
+    model.pop_element(index=12)
+
+
+def test_replica_follows_edit_log(model):
+    log, length = model.edit_log()
+    replica = MachineReplica(log, length, model.clone_machine())
+    edit(model)
+
+    run = FullRun(model, deferred=True)
+    run.use_machine(replica.machine_for(run))
+    run.execute()
+
+    expected = model.get_result()
+    assert len(run.result) == len(expected)
+    for key in ('pos', 'xrms', 'yrms'):
+        assert np.allclose(run.result[key], expected[key], equal_nan=True)
+
+
+def test_replica_of_another_log_is_refused(model):
+    log, length = model.edit_log()
+    replica = MachineReplica(log, length, model.clone_machine())
+    model.machine = model.clone_machine()  # a new machine starts a new log
+    with pytest.raises(RuntimeError):
+        replica.machine_for(FullRun(model, deferred=True))
+
+
+def test_requests_clone_only_for_new_log(model, monkeypatch):
+    clones = []
+    clone_machine = model.clone_machine
+
+    def counting_clone():
+        clones.append(1)
+        return clone_machine()
+    monkeypatch.setattr(model, 'clone_machine', counting_clone)
+
+    worker = SimulationWorker()  # not started, requests only queue up
+    worker.request(model)
+    edit(model)
+    worker.request(model)
+    edit(model)
+    worker.request(model)
+    assert len(clones) == 1
+
+    model.machine = clone_machine()
+    worker.request(model)
+    assert len(clones) == 2
+
+
+def test_adopted_machine_saves_the_clone(model, monkeypatch):
+    from flame import Machine
+
+    clones = []
+    clone_machine = model.clone_machine
+
+    def counting_clone():
+        clones.append(1)
+        return clone_machine()
+    monkeypatch.setattr(model, 'clone_machine', counting_clone)
+
+    loaded = FullRun(model, machine=Machine(model.clone_machine().conf()))  # as the lattice loader runs it
+    clones.clear()
+    loaded.execute()
+    worker = SimulationWorker()
+    worker.adoptMachine(loaded)
+    edit(model)
+    worker.request(model)
+    assert not clones
+
+    run = worker._pending
+    replica = MachineReplica(*worker._base)
+    run.use_machine(replica.machine_for(run))
+    run.execute()
+    assert np.allclose(run.result['xrms'], model.get_result()['xrms'], equal_nan=True)